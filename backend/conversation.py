@@ -0,0 +1,274 @@
+import os
+import re
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from cachetools import TTLCache
+from sqlalchemy import case, desc, func, insert, select, update
+
+from models import Interaction
+
+logger = logging.getLogger(__name__)
+
+# Turns of conversation history sent to the LLM
+HISTORY_TURNS = 5
+# Turns loaded per request: the history plus any Socratic prompt recent enough
+# to still be active (it expires after 3 turns)
+RECENT_TURNS = 10
+# Consecutive non-enhanced prompts (counting the current one) that clear a Socratic prompt
+NON_ENHANCED_LIMIT = 2
+
+# Phrases that end Socratic questioning when they appear in a prompt
+STOP_PHRASES = [
+    "stop asking", "no more questions", "stop questioning",
+    "please stop", "don't ask", "no questions", "stop the questions",
+    "go with the", "just explain", "give me the", "skip the questions",
+    "start explaining", "begin explaining", "explain", "start the explanation",
+    "i'm good", "nah im good", "im good", "that's enough", "thats enough"
+]
+# One alternation matches all phrases in a single pass over the prompt
+_STOP_RE = re.compile("|".join(re.escape(p) for p in STOP_PHRASES))
+
+# Recent turns per conversation, kept in step with this process's own writes so
+# back-to-back requests on a conversation (e.g. /interact then /answer) skip the
+# query. Writes made by other processes (workers) are only seen once an entry
+# expires, so the default TTL is short; raise it only when running one process.
+HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", "10000"))
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", "5"))
+_history_cache = TTLCache(maxsize=HISTORY_CACHE_SIZE, ttl=HISTORY_CACHE_TTL)
+# turn_index of each conversation's latest Socratic prompt (None if it has none),
+# for the check made when logging an answer; same caveat and TTL as the history cache
+_socratic_cache = TTLCache(maxsize=HISTORY_CACHE_SIZE, ttl=HISTORY_CACHE_TTL)
+_UNKNOWN = object()
+
+
+async def fetch_recent_turns(db, conversation_id: str):
+    """
+    Loads the most recent turns of a conversation (newest first) in a single
+    query. Window functions over the whole conversation also return its highest
+    turn_index and the turn_index of its latest Socratic prompt.
+    Returns (turns, max_turn, last_socratic_turn); the indexes are None if absent.
+    """
+    max_turn = func.max(Interaction.turn_index).over().label("max_turn")
+    last_socratic_turn = func.max(
+        case((Interaction.socratic_system_prompt.isnot(None), Interaction.turn_index))
+    ).over().label("last_socratic_turn")
+    rows = (await db.execute(
+        select(Interaction, max_turn, last_socratic_turn)
+        .where(Interaction.conversation_id == conversation_id)
+        .order_by(desc(Interaction.turn_index))
+        .limit(RECENT_TURNS)
+    )).all()
+    if not rows:
+        return [], None, None
+    return [row[0] for row in rows], rows[0].max_turn, rows[0].last_socratic_turn
+
+
+async def load_recent_turns(db, conversation_id: str):
+    """fetch_recent_turns, served from the history cache when possible"""
+    cached = _history_cache.get(conversation_id)
+    if cached is not None:
+        logger.debug("History cache hit for conversation %s", conversation_id)
+        return cached
+    result = await fetch_recent_turns(db, conversation_id)
+    _history_cache[conversation_id] = result
+    return result
+
+
+def remember_turn(interaction: Interaction) -> None:
+    """Writes a newly logged or updated turn through to the cached recent turns"""
+    cached = _history_cache.get(interaction.conversation_id)
+    if cached is None:
+        return
+    turns, max_turn, _ = cached
+    turns = [t for t in turns if t.id != interaction.id] + [interaction]
+    turns.sort(key=lambda t: t.turn_index, reverse=True)
+    turns = turns[:RECENT_TURNS]
+    if max_turn is None or interaction.turn_index > max_turn:
+        max_turn = interaction.turn_index
+    # A Socratic prompt older than the recent turns has expired anyway
+    last_socratic_turn = next(
+        (t.turn_index for t in turns if t.socratic_system_prompt is not None), None
+    )
+    _history_cache[interaction.conversation_id] = (turns, max_turn, last_socratic_turn)
+
+
+async def load_last_socratic_turn(db, conversation_id: str, refresh: bool = False) -> Optional[int]:
+    """
+    turn_index of the conversation's latest Socratic prompt, or None; cached.
+    refresh bypasses the cached value and re-reads it.
+    """
+    last_socratic_turn = _UNKNOWN if refresh else _socratic_cache.get(conversation_id, _UNKNOWN)
+    if last_socratic_turn is _UNKNOWN:
+        last_socratic_turn = await db.scalar(
+            select(func.max(Interaction.turn_index)).where(
+                Interaction.conversation_id == conversation_id,
+                Interaction.socratic_system_prompt.isnot(None)
+            )
+        )
+        _socratic_cache[conversation_id] = last_socratic_turn
+    return last_socratic_turn
+
+
+def remember_socratic_turn(conversation_id: str, turn_index: int) -> None:
+    """Records a newly stored Socratic prompt in the cache"""
+    last_socratic_turn = _socratic_cache.get(conversation_id)
+    if last_socratic_turn is None or turn_index > last_socratic_turn:
+        _socratic_cache[conversation_id] = turn_index
+
+
+def forget_socratic_turn(conversation_id: str) -> None:
+    """Drops the cached Socratic turn, e.g. after a prompt is cleared or a write rolled back"""
+    _socratic_cache.pop(conversation_id, None)
+
+
+async def log_turn(db, **values) -> Interaction:
+    """
+    Inserts and commits a turn at the conversation's next turn_index, computed in
+    the INSERT itself so there is no separate lookup of the latest turn.
+    Returns the logged turn.
+    """
+    next_turn_index = (
+        select(func.coalesce(func.max(Interaction.turn_index), -1) + 1)
+        .where(Interaction.conversation_id == values["conversation_id"])
+        .scalar_subquery()
+    )
+    # The returned row holds the values as stored (final_answer truncated)
+    interaction = (await db.scalars(
+        insert(Interaction)
+        .values(turn_index=next_turn_index, **values)
+        .returning(Interaction)
+    )).one()
+    await db.commit()
+    remember_turn(interaction)
+    return interaction
+
+
+async def log_turns(db, rows: List[Dict]) -> None:
+    """
+    Inserts and commits many turns, each with its own turn_index, in one
+    transaction: rows with the same columns go out as a single executemany.
+    The path for backfills and imports rather than calling log_turn in a loop.
+    Scripts should get the session from models.database(), which disposes the
+    pooled engine so the process can exit:
+
+        async with database() as db:
+            await log_turns(db, rows)
+    """
+    if not rows:
+        return
+    await db.execute(insert(Interaction), rows)
+    await db.commit()
+    for conversation_id in {row["conversation_id"] for row in rows}:
+        _history_cache.pop(conversation_id, None)
+        forget_socratic_turn(conversation_id)
+
+
+async def resolve_socratic_context(
+    db,
+    conversation_id: str,
+    current_turn_index: Optional[int],
+    user_prompt: str,
+    enhancer_enabled: bool
+) -> Tuple[List[Dict[str, str]], Optional[str], int]:
+    """
+    Builds the LLM conversation history and decides whether the latest Socratic
+    prompt still applies to this turn. It expires after 3 turns, after 2
+    consecutive non-enhanced prompts, or when the user asks to stop; the last
+    two also clear it from the database.
+    current_turn_index defaults to the turn after the latest one.
+    Returns (conversation_history, active_socratic_prompt, current_turn_index).
+    """
+    recent, max_turn, last_socratic_turn = await load_recent_turns(db, conversation_id)
+    if current_turn_index is None:
+        current_turn_index = (max_turn + 1) if max_turn is not None else 0
+
+    # Get the most recent Socratic prompt (tracked over all turns, not just the recent ones)
+    socratic_turn = next((t for t in recent if t.turn_index == last_socratic_turn), None)
+
+    active_socratic_prompt = None
+    socratic_prompt_turn_index = None
+    if socratic_turn:
+        active_socratic_prompt = socratic_turn.socratic_system_prompt
+        socratic_prompt_turn_index = socratic_turn.turn_index
+        logger.debug("Found Socratic prompt at turn_index %d", socratic_prompt_turn_index)
+
+    # Last 5 turns for conversation history (newest first; walked in reverse below
+    # for chronological order)
+    history_turns = recent[:HISTORY_TURNS]
+
+    logger.info(f"Found {len(history_turns)} previous turns for context")
+
+    # Build conversation history for LLM
+    conversation_history = []
+    for prev_turn in reversed(history_turns):
+        if prev_turn.final_answer:  # Only include completed turns
+            conversation_history.append({
+                "role": "user",
+                "content": prev_turn.original_prompt
+            })
+            conversation_history.append({
+                "role": "assistant",
+                "content": prev_turn.final_answer
+            })
+
+    # Expire Socratic prompt if it's been more than 3 turns
+    if active_socratic_prompt and socratic_prompt_turn_index is not None:
+        turns_since_socratic = current_turn_index - socratic_prompt_turn_index
+        if turns_since_socratic >= 3:
+            logger.info(f"Socratic prompt expired after {turns_since_socratic} turns")
+            active_socratic_prompt = None
+        else:
+            logger.debug("Socratic prompt active (turns since: %d)", turns_since_socratic)
+
+    # Check for consecutive non-enhanced prompts after Socratic prompt
+    should_clear_socratic = False
+    if active_socratic_prompt and socratic_prompt_turn_index is not None and not enhancer_enabled:
+        # Count consecutive non-enhanced prompts since the Socratic prompt, starting
+        # with the current request and walking back through COMPLETED turns (must
+        # have final_answer); stop as soon as the limit is reached
+        consecutive_non_enhanced = 1
+        for turn in recent:
+            if turn.turn_index <= socratic_prompt_turn_index or consecutive_non_enhanced >= NON_ENHANCED_LIMIT:
+                break
+            if turn.final_answer is None:
+                continue
+            # Non-enhanced: mode is None or empty string (enhancer disabled)
+            if turn.mode:  # Enhanced prompt - stop counting (we only care about consecutive from the end)
+                logger.debug("  Found enhanced turn %d, stopping count", turn.turn_index)
+                break
+            consecutive_non_enhanced += 1
+
+        logger.info(f"Consecutive non-enhanced prompts since Socratic (turn {socratic_prompt_turn_index}): {consecutive_non_enhanced}")
+
+        # Clear if 2 or more consecutive non-enhanced prompts
+        if consecutive_non_enhanced >= NON_ENHANCED_LIMIT:
+            logger.info(f"✓ CLEARING Socratic prompt after {consecutive_non_enhanced} consecutive non-enhanced prompt(s)")
+            should_clear_socratic = True
+            active_socratic_prompt = None
+        else:
+            logger.debug("Socratic prompt remains active (%d consecutive non-enhanced, need 2+)", consecutive_non_enhanced)
+
+    # Detect explicit requests to stop questioning (still works immediately)
+    if active_socratic_prompt and _STOP_RE.search(user_prompt.lower()):
+        logger.info("User explicitly requested to stop Socratic questioning - clearing prompt")
+        should_clear_socratic = True
+        active_socratic_prompt = None
+
+    # Clear Socratic prompt from database if needed
+    if should_clear_socratic and socratic_turn:
+        try:
+            await db.execute(
+                update(Interaction)
+                .where(Interaction.id == socratic_turn.id)
+                .values(socratic_system_prompt=None)
+            )
+            await db.commit()
+            _history_cache.pop(conversation_id, None)
+            forget_socratic_turn(conversation_id)
+            logger.info(f"✓ Cleared Socratic prompt from database (turn {socratic_turn.turn_index})")
+        except Exception as e:
+            logger.error(f"✗ Error clearing Socratic prompt from database: {str(e)}", exc_info=True)
+            await db.rollback()
+
+    return conversation_history, active_socratic_prompt, current_turn_index
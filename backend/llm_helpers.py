@@ -1,9 +1,41 @@
 import os
+import re
+import json
+import asyncio
+import hashlib
 import logging
+import orjson
+import httpx
+from functools import lru_cache, partial
 from pathlib import Path
-from openai import OpenAI
-from typing import Dict, List, Optional, Tuple
+from openai import AsyncOpenAI, APIConnectionError, InternalServerError, RateLimitError
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 from dotenv import load_dotenv
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
+from tenacity import (
+    before_sleep_log,
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+import tiktoken
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # Optional: without it every prompt is classified by the LLM
+    SentenceTransformer = None
+
+try:
+    import spacy
+except ImportError:  # Optional: used for local topic extraction
+    spacy = None
+
+try:
+    import faiss
+except ImportError:  # Optional: without it only exact repeats are served from the cache
+    faiss = None
 
 logger = logging.getLogger(__name__)
 
@@ -16,54 +48,36 @@ load_dotenv(dotenv_path=env_path)
 # Model to use (can be configured)
 MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 
-# Lazy initialization of OpenAI client
-_client = None
-
-def get_client():
-    """Get or create the OpenAI client (lazy initialization)"""
-    global _client
-    if _client is None:
-        logger.debug("Initializing OpenAI client...")
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            logger.error("OPENAI_API_KEY not found in environment")
-            raise ValueError(
-                f"OPENAI_API_KEY not found in environment variables. "
-                f"Please set it in your .env file at {env_path}"
-            )
-        logger.debug(f"API key found (length: {len(api_key) if api_key else 0})")
-        try:
-            logger.debug("Creating OpenAI client instance...")
-            import httpx
-            logger.debug(f"httpx version: {httpx.__version__}")
-            logger.debug(f"OpenAI module: {OpenAI.__module__}")
-            _client = OpenAI(api_key=api_key)
-            logger.info("✓ OpenAI client initialized successfully")
-        except Exception as e:
-            logger.error(f"✗ Error creating OpenAI client: {str(e)}", exc_info=True)
-            logger.error(f"Error type: {type(e).__name__}")
-            logger.error(f"Error args: {e.args}")
-            raise
-    else:
-        logger.debug("Reusing existing OpenAI client")
-    return _client
-
-
-def classify_intent(prompt: str) -> Dict[str, str]:
-    """
-    Classifies the learning intent of a prompt and extracts the topic.
-    Returns: {"intent": "...", "topic": "..."}
-    """
-    logger.debug(f"classify_intent called with prompt length: {len(prompt)}")
-    classification_prompt = f"""Analyze the following user prompt and classify it by learning intent and extract the main topic.
+# Classification is a short 6-way label task, so it can run on a smaller and
+# faster model than rewriting. Set OPENAI_CLASSIFY_JSON_MODE=false for models
+# without JSON mode; their output is then parsed with _INTENT_FIELD_RE
+CLASSIFY_MODEL = os.getenv("OPENAI_CLASSIFY_MODEL", MODEL)
+CLASSIFY_JSON_MODE = os.getenv("OPENAI_CLASSIFY_JSON_MODE", "true").lower() == "true"
+CLASSIFY_MAX_TOKENS = 40  # {"intent": ..., "topic": ...} is well under this
+
+# Output caps for the other calls: a rewrite (prompt plus feedback bullets) stays
+# within a few hundred tokens; final answers get a configurable budget
+REWRITE_MAX_TOKENS = 500
+ANSWER_MAX_TOKENS = int(os.getenv("ANSWER_MAX_TOKENS", "2048"))
+
+# Learning intent categories and their descriptions. Used both in the LLM
+# classification prompt and as the labels for the local embedding classifier.
+INTENTS: List[Tuple[str, str]] = [
+    ("direct_answer", "User wants a quick, direct answer without explanation"),
+    ("conceptual", "User wants to understand a concept deeply"),
+    ("debugging", "User is trying to fix an error or solve a problem"),
+    ("intuition", 'User wants to build intuition or understand "why" something works'),
+    ("example", "User wants examples or demonstrations"),
+    ("other", "Doesn't fit the above categories"),
+]
+_INTENT_CATEGORIES = "\n".join(f'- "{label}": {desc}' for label, desc in INTENTS)
+_INTENT_FIELD_RE = re.compile(r'"(intent|topic)"\s*:\s*"([^"]*)"')
+
+# Classification prompt, split around the user's prompt
+_CLASSIFY_PROMPT_HEAD = f"""Analyze the following user prompt and classify it by learning intent and extract the main topic.
 
 Learning Intent Categories:
-- "direct_answer": User wants a quick, direct answer without explanation
-- "conceptual": User wants to understand a concept deeply
-- "debugging": User is trying to fix an error or solve a problem
-- "intuition": User wants to build intuition or understand "why" something works
-- "example": User wants examples or demonstrations
-- "other": Doesn't fit the above categories
+{_INTENT_CATEGORIES}
 
 Return your response in this exact JSON format:
 {{
@@ -72,39 +86,588 @@ Return your response in this exact JSON format:
 }}
 
 User prompt:
-{prompt}
+"""
+_CLASSIFY_PROMPT_TAIL = "\n\nJSON response:"
+
+# Request fragments shared by every classification/rewrite/answer call
+_JSON_FORMAT = {"type": "json_object"}
+_CLASSIFY_SYSTEM_MSG = {
+    "role": "system",
+    "content": "You are a learning intent classifier. Always respond with valid JSON only.",
+}
+_REWRITE_SYSTEM_MSG = {
+    "role": "system",
+    "content": "You are a prompt rewriting assistant that helps make prompts more learning-oriented. Always respond with valid JSON only.",
+}
+_ANSWER_SYSTEM_MSG = {
+    "role": "system",
+    "content": (
+        "You are a helpful AI assistant focused on teaching and learning. "
+        "Provide clear, educational responses. You can reference previous parts of the conversation when relevant."
+    ),
+}
+
+# Intent-specific guidance added to the rewrite prompt.
+# "direct_answer" and "other" just fall back to the general learning behaviour
+_INTENT_GUIDANCE: Dict[str, str] = {
+    "debugging": """Intent is "debugging", so the rewritten prompt should also ask for:
+- likely root causes,
+- an ordered checklist of things to try,
+- what extra context (error messages, code snippets) to provide next time.""",
+    "intuition": """Intent is "intuition", so focus the rewritten prompt on:
+- metaphors, visualizations and "why it works" reasoning,
+- comparisons to simpler ideas the user may know,
+- 1-2 probing questions that challenge common misconceptions.""",
+    "example": """Intent is "example", so the rewritten prompt should ask for:
+- several diverse, concrete examples,
+- one close to a real-world scenario a student might see,
+- a brief explanation of why each example fits.""",
+    "conceptual": """Intent is "conceptual", so emphasize:
+- clear definitions,
+- connections between related concepts,
+- a short plain-language summary.""",
+}
+
+# Rewrite instruction and resulting strategy name for each learning mode
+_MODE_REWRITES: Dict[str, Tuple[str, str]] = {
+    "learning": ("""Turn the question into a **deep, structured learning task**, not just a wordier version. Keep the user's goal and topic, and ask for:
+- a **high-level intuition first**, then a formal explanation,
+- a **step-by-step walkthrough** (for algorithms/processes),
+- **2–3 concrete examples or scenarios**,
+- if applicable, **a small numerical or code example**,
+- **1 short diagnostic question or mini-exercise** at the end.
+Keep it to 1–3 sentences or bullets; don't restate the original verbatim.
+Example: "Explain [concept] starting from an intuitive explanation, then give a step-by-step walkthrough and a small numerical example. After that, show 2–3 real-world applications, and finish with a short question I can answer to check my understanding.\"""", "learning_explanation"),
+    "socratic": ("""Turn the prompt into a **strict meta-instruction** for a Socratic tutor that enforces ALL of:
+1. First ask **exactly 2 clarifying questions**, one after the other.
+2. NO explanation, definitions or hints until the user has answered **BOTH**.
+3. Then ask **1 probing question** based on their answers.
+4. Only after that answer start explaining, tailored **specifically** to their misunderstandings.
+5. Keep alternating: targeted question, wait for the answer, **small, incremental** explanation. Never dump a full explanation or skip ahead.
+6. Tone: curious, patient, encouraging.
+The meta-prompt describes HOW to conduct the interaction; it must NOT contain the actual questions or explanations.
+Example: "You are a Socratic tutor. Begin by asking me exactly two clarifying questions about my understanding of [topic]. Wait for my responses before explaining anything. After I answer both, ask one targeted follow-up question. Only then begin a step-by-step explanation tailored to my answers. Continue alternating between asking and explaining in small increments.\"""", "socratic_questioning"),
+}
+
+# Feedback requirements shared by the single- and multi-mode rewrite prompts
+_REWRITE_REQUIREMENTS = """2. Give 2-3 feedback bullets that name the most important change (not every tweak), tie it to the user's wording or goal, and give ONE concrete "next time you write a prompt, try X" tip. No generic feedback like "this will enhance your learning"."""
+
+# Fixed fragments of the rewrite prompts; the user's prompt follows the head
+_REWRITE_PROMPT_HEAD = 'Given:\n- original prompt: "'
+_MULTI_REWRITE_INSTRUCTIONS = f"""
+
+For EACH mode below you MUST:
+1. Rewrite the prompt following that mode's instruction (if helpful for the mode and intent).
+{_REWRITE_REQUIREMENTS}
+
+Rewriting instructions per mode:
+"""
+_MODE_SECTIONS = {mode: f"### Mode: {mode}\n{instruction}" for mode, (instruction, _) in _MODE_REWRITES.items()}
+_MODE_SCHEMAS = {
+    mode: f'  "{mode}": {{"rewrittenPrompt": "...", "rewriteStrategy": "{strategy}", "promptFeedback": ["...", "..."]}}'
+    for mode, (_, strategy) in _MODE_REWRITES.items()
+}
+
+# Local classifier settings: prompts whose best label similarity is below the
+# threshold are sent to the LLM instead
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+SPACY_MODEL = os.getenv("SPACY_MODEL", "en_core_web_sm")
+INTENT_SIMILARITY_THRESHOLD = float(os.getenv("INTENT_SIMILARITY_THRESHOLD", "0.35"))
+
+# Client-side limits for the OpenAI API: concurrent requests, plus requests
+# and (estimated prompt) tokens per minute
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "20"))
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "200000"))
+
+# Context window of MODEL and the completion budget reserved out of it when a
+# call doesn't set max_tokens; prompts that can't fit are rejected locally
+MODEL_CONTEXT_TOKENS = int(os.getenv("MODEL_CONTEXT_TOKENS", "128000"))
+MAX_COMPLETION_TOKENS = int(os.getenv("MAX_COMPLETION_TOKENS", "16384"))
+
+# Connection pool for the OpenAI HTTP client
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONN", "100"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "50"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+
+# Exact-match cache of non-streamed chat completions (same model, messages and
+# parameters), checked before any throttling or network call
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "10000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+
+# Attempts per chat completion on 429s, 5xx and connection errors
+OPENAI_MAX_ATTEMPTS = int(os.getenv("OPENAI_MAX_ATTEMPTS", "5"))
+
+# Semantic cache settings: a prompt whose embedding is at least this similar to
+# an earlier one reuses that prompt's classification/rewrite
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+# Most results each of the classification and rewrite caches keeps (in memory and on disk)
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "10000"))
+CACHE_DIR = Path(os.getenv("CACHE_DIR", backend_dir / ".cache"))
+
+# How often rewrite_prompt_batch polls a submitted Batch API job
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "30"))
+
+
+def _load_local_classifier():
+    """Load the embedding model, label embeddings and spaCy pipeline (None if unavailable)"""
+    if SentenceTransformer is None or spacy is None:
+        logger.info("sentence-transformers/spaCy not installed, intent classification will use the LLM")
+        return None, None, None, None
+    try:
+        model = SentenceTransformer(EMBEDDING_MODEL)
+        # "other" has no meaningful description to match against, so it is left to the LLM
+        labels = [label for label, _ in INTENTS if label != "other"]
+        label_emb = model.encode(
+            [desc for label, desc in INTENTS if label != "other"],
+            normalize_embeddings=True,
+        )
+        nlp = spacy.load(SPACY_MODEL, disable=["ner", "lemmatizer"])
+        logger.info(f"✓ Local intent classifier loaded ({EMBEDDING_MODEL}, {SPACY_MODEL})")
+        return model, labels, label_emb, nlp
+    except Exception as e:
+        logger.warning(f"Could not load local intent classifier, using the LLM instead: {str(e)}")
+        return None, None, None, None
+
+
+_EMBED_MODEL, _LOCAL_LABELS, _LABEL_EMB, _NLP = _load_local_classifier()
+
+
+@lru_cache(maxsize=256)
+def _embed(prompt: str):
+    """Normalized embedding of the prompt (memoized, the classifier and both caches share it)"""
+    return _EMBED_MODEL.encode(prompt, normalize_embeddings=True)
+
+
+def _extract_topic(prompt: str) -> Optional[str]:
+    """Returns the longest noun chunk of the prompt as its topic (None if there is none)"""
+    chunks = [
+        chunk.text.strip().lower()
+        for chunk in _NLP(prompt).noun_chunks
+        if chunk.root.pos_ != "PRON" and chunk.root.tag_ not in ("WP", "WDT")
+    ]
+    return max(chunks, key=len) if chunks else None
+
+
+def _classify_locally(prompt: str) -> Optional[Dict[str, str]]:
+    """
+    Classifies the prompt without an LLM call by comparing its embedding to the
+    intent label descriptions. Returns None when the classifier is unavailable,
+    not confident enough, or no topic could be extracted.
+    """
+    if _EMBED_MODEL is None:
+        return None
+    scores = _LABEL_EMB @ _embed(prompt)
+    best = int(scores.argmax())
+    if scores[best] <= INTENT_SIMILARITY_THRESHOLD:
+        logger.debug("Local classifier not confident (score %.2f), falling back to LLM", scores[best])
+        return None
+    topic = _extract_topic(prompt)
+    if not topic:
+        return None
+    logger.debug("Local classifier picked '%s' (score %.2f)", _LOCAL_LABELS[best], scores[best])
+    return {"intent": _LOCAL_LABELS[best], "topic": topic}
+
+
+class _SemanticCache:
+    """
+    Cache of LLM results looked up by prompt. Exact repeats are served from a
+    dict keyed on a hash of the prompt; near-identical prompts are matched by
+    inner product against a FAISS index of normalized prompt embeddings. Each
+    sub-key (e.g. mode and intent for rewrites) gets its own index so results
+    are never shared across them. Holds at most SEMANTIC_CACHE_SIZE results,
+    evicting the oldest first. Values must be JSON-serializable.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        # Values by prompt hash, oldest first
+        self._exact: Dict[str, Any] = {}
+        self._indexes: Dict[str, Any] = {}
+        # Prompt hash of each vector in the sub-key's index, in the same (insertion) order
+        self._entries: Dict[str, List[str]] = {}
+        self._load()
+
+    @property
+    def _semantic(self) -> bool:
+        return faiss is not None and _EMBED_MODEL is not None
+
+    @staticmethod
+    def _hash(prompt: str, key: str) -> str:
+        return hashlib.sha256(f"{prompt}|{key}".encode()).hexdigest()
+
+    def get(self, prompt: str, key: str = "") -> Optional[Any]:
+        """Returns the cached value for the prompt (None on a miss)"""
+        value = self._exact.get(self._hash(prompt, key))
+        if value is not None or not self._semantic:
+            return value
+        index = self._indexes.get(key)
+        if index is None or index.ntotal == 0:
+            return None
+        scores, ids = index.search(_embed(prompt)[None].astype("float32"), 1)
+        if scores[0, 0] < SEMANTIC_CACHE_THRESHOLD:
+            return None
+        logger.debug("%s cache hit (similarity %.2f)", self.name, scores[0, 0])
+        return self._exact[self._entries[key][ids[0, 0]]]
+
+    def put(self, prompt: str, value: Any, key: str = "") -> None:
+        prompt_hash = self._hash(prompt, key)
+        if prompt_hash in self._exact:
+            self._exact[prompt_hash] = value
+            return
+        self._exact[prompt_hash] = value
+        if self._semantic:
+            emb = _embed(prompt)[None].astype("float32")
+            index = self._indexes.get(key)
+            if index is None:
+                index = self._indexes[key] = faiss.IndexFlatIP(emb.shape[1])
+                self._entries[key] = []
+            index.add(emb)
+            self._entries[key].append(prompt_hash)
+        if len(self._exact) > SEMANTIC_CACHE_SIZE:
+            self._evict()
+
+    def _evict(self) -> None:
+        """
+        Drops the oldest results (a tenth of the cache at a time, so indexes are
+        compacted once per batch rather than on every put)
+        """
+        count = len(self._exact) - SEMANTIC_CACHE_SIZE + max(1, SEMANTIC_CACHE_SIZE // 10)
+        evicted = set()
+        for prompt_hash in list(self._exact)[:count]:
+            del self._exact[prompt_hash]
+            evicted.add(prompt_hash)
+        # Each sub-key's oldest vectors are at the front of its index
+        for key, entries in list(self._entries.items()):
+            stale = 0
+            while stale < len(entries) and entries[stale] in evicted:
+                stale += 1
+            if stale == len(entries):
+                del self._indexes[key], self._entries[key]
+            elif stale:
+                self._indexes[key].remove_ids(faiss.IDSelectorRange(0, stale))
+                del entries[:stale]
+        logger.debug("Evicted %d %s cache entries", len(evicted), self.name)
+
+    def _path(self, key: Optional[str] = None) -> Path:
+        if key is None:
+            return CACHE_DIR / f"{self.name}.json"
+        return CACHE_DIR / f"{self.name}.{hashlib.sha256(key.encode()).hexdigest()[:16]}.faiss"
+
+    def save(self) -> None:
+        """Writes the cache to CACHE_DIR so restarts start warm"""
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            with open(self._path(), "w") as f:
+                json.dump({"version": 2, "exact": self._exact, "entries": self._entries}, f)
+            for key, index in self._indexes.items():
+                faiss.write_index(index, str(self._path(key)))
+        except Exception as e:
+            logger.warning(f"Could not save {self.name} cache: {str(e)}")
+
+    def _load(self) -> None:
+        path = self._path()
+        if not path.exists():
+            return
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            self._exact = data["exact"]
+            # Older files stored values rather than hashes in "entries"; their
+            # indexes can't be evicted from, so only the exact matches are kept
+            if self._semantic and data.get("version") == 2:
+                for key, entries in data["entries"].items():
+                    self._indexes[key] = faiss.read_index(str(self._path(key)))
+                    self._entries[key] = entries
+            if len(self._exact) > SEMANTIC_CACHE_SIZE:
+                self._evict()
+            logger.info(f"✓ Loaded {self.name} cache ({len(self._exact)} entries)")
+        except Exception as e:
+            logger.warning(f"Could not load {self.name} cache, starting empty: {str(e)}")
+            self._exact, self._indexes, self._entries = {}, {}, {}
+
+
+_intent_cache = _SemanticCache("intent")
+_rewrite_cache = _SemanticCache("rewrite")
+
+
+def save_caches() -> None:
+    """Persists the classification and rewrite caches (call on shutdown)"""
+    _intent_cache.save()
+    _rewrite_cache.save()
+
 
-JSON response:"""
+# The OpenAI client is created once at import. It runs on our own
+# httpx.AsyncClient with HTTP/2, so concurrent requests are multiplexed over a
+# few pooled TLS connections instead of each paying for a handshake
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+_MISSING_KEY_MSG = (
+    f"OPENAI_API_KEY not found in environment variables. "
+    f"Please set it in your .env file at {env_path}"
+)
+
+
+def _create_client():
+    """Create the AsyncOpenAI client and its HTTP client (None, None without an API key)"""
+    if not OPENAI_API_KEY:
+        logger.error("OPENAI_API_KEY not found in environment")
+        return None, None
+    try:
+        logger.debug("Creating OpenAI client (httpx %s)...", httpx.__version__)
+        http_client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            ),
+        )
+        # Retries are handled by _chat, so the SDK's own are disabled
+        client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client, max_retries=0)
+        logger.info("✓ OpenAI client initialized successfully")
+        return client, http_client
+    except Exception as e:
+        logger.error(f"✗ Error creating OpenAI client: {str(e)}", exc_info=True)
+        return None, None
+
+
+_client, _http_client = _create_client()
+
+
+def get_client():
+    """Returns the shared AsyncOpenAI client (raises ValueError if OPENAI_API_KEY isn't set)"""
+    if _client is None:
+        raise ValueError(_MISSING_KEY_MSG)
+    return _client
+
+
+def set_client(client) -> None:
+    """Replaces the shared client, e.g. with a stub in tests"""
+    global _client
+    _client = client
+
+
+async def close_client() -> None:
+    """Closes the OpenAI client and its connection pool (call on shutdown)"""
+    global _client, _http_client
+    if _client is not None:
+        await _client.close()
+    if _http_client is not None:
+        await _http_client.aclose()
+    _client = _http_client = None
+
+
+_SEM = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+_response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+# Non-streamed requests currently being sent, by the same key as _response_cache
+_inflight: Dict[bytes, "asyncio.Task"] = {}
+_rpm_limiter = AsyncLimiter(OPENAI_RPM, 60)
+_tpm_limiter = AsyncLimiter(OPENAI_TPM, 60)
+
+
+def _load_encoder():
+    """Load the tiktoken encoding for MODEL once (None if it can't be loaded)"""
+    try:
+        try:
+            return tiktoken.encoding_for_model(MODEL)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning(f"Could not load tiktoken encoding, estimating tokens from length: {str(e)}")
+        return None
+
+
+_ENC = _load_encoder()
+
+
+def _count_tokens(messages: List[Dict[str, str]]) -> int:
+    """Estimates the prompt tokens of a chat request"""
+    text = "".join(message["content"] for message in messages)
+    if _ENC is None:
+        return len(text) // 4
+    # ~4 tokens of per-message overhead for role and separators
+    return len(_ENC.encode(text)) + 4 * len(messages)
+
+
+class PromptTooLongError(ValueError):
+    """Raised when a request cannot fit in the model's context window"""
+
+
+_backoff = wait_random_exponential(min=1, max=30)
+
+
+def _retry_wait(retry_state) -> float:
+    """Waits as long as the API's Retry-After header asks, else exponential backoff with jitter"""
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(float(retry_after), 60.0)
+    except (TypeError, ValueError):
+        return _backoff(retry_state)
+
+
+@retry(
+    stop=stop_after_attempt(OPENAI_MAX_ATTEMPTS),
+    wait=_retry_wait,
+    retry=retry_if_exception_type((RateLimitError, InternalServerError, APIConnectionError)),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+    reraise=True,
+)
+async def _chat(**kwargs):
+    """
+    Calls chat.completions.create on the shared client, throttled so the
+    process stays under OPENAI_MAX_CONCURRENCY in-flight requests and the
+    OPENAI_RPM / OPENAI_TPM budgets instead of running into 429s. Rate limits,
+    5xx responses and connection errors are retried up to OPENAI_MAX_ATTEMPTS
+    times.
+    Raises PromptTooLongError without calling the API when the prompt plus the
+    completion budget exceeds MODEL_CONTEXT_TOKENS.
+    Non-streamed responses are served from _response_cache when the exact same
+    request was made within RESPONSE_CACHE_TTL seconds, and concurrent identical
+    requests share a single API call.
+    """
+    if _client is None:
+        raise ValueError(_MISSING_KEY_MSG)
+    if kwargs.get("stream"):
+        return await _create(kwargs)
+    cache_key = hashlib.blake2b(orjson.dumps(kwargs, option=orjson.OPT_SORT_KEYS)).digest()
+    cached = _response_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    task = _inflight.get(cache_key)
+    if task is None:
+        task = _inflight[cache_key] = asyncio.ensure_future(_create(kwargs, cache_key))
+        task.add_done_callback(partial(_forget_inflight, cache_key))
+    # Shielded so one caller being cancelled doesn't cancel the call for the others
+    return await asyncio.shield(task)
+
+
+def _forget_inflight(cache_key: bytes, task: "asyncio.Task") -> None:
+    _inflight.pop(cache_key, None)
+    # Mark the error as retrieved in case every caller was cancelled meanwhile
+    if not task.cancelled():
+        task.exception()
+
+
+async def _create(kwargs: Dict[str, Any], cache_key: Optional[bytes] = None):
+    """Sends one request under the concurrency and rate limits, caching it if keyed"""
+    tokens = _count_tokens(kwargs["messages"])
+    budget = MODEL_CONTEXT_TOKENS - (kwargs.get("max_tokens") or MAX_COMPLETION_TOKENS)
+    if tokens > budget:
+        raise PromptTooLongError(f"Prompt is ~{tokens} tokens, the limit is {budget}")
+    async with _SEM:
+        await _tpm_limiter.acquire(min(tokens, OPENAI_TPM))
+        async with _rpm_limiter:
+            response = await _client.chat.completions.create(**kwargs)
+    if cache_key is not None:
+        _response_cache[cache_key] = response
+    return response
+
+
+# Fixed parameters of each call site, bound once so calls only pass messages
+_CLASSIFY_PARAMS: Dict[str, Any] = {
+    "model": CLASSIFY_MODEL,
+    "temperature": 0.3,
+    "max_tokens": CLASSIFY_MAX_TOKENS,
+    **({"response_format": _JSON_FORMAT} if CLASSIFY_JSON_MODE else {}),
+}
+_REWRITE_PARAMS: Dict[str, Any] = {
+    "model": MODEL,
+    "temperature": 0.5,
+    "max_tokens": REWRITE_MAX_TOKENS,
+    "response_format": _JSON_FORMAT,
+}
+_classify_call = partial(_chat, **_CLASSIFY_PARAMS)
+_rewrite_call = partial(_chat, **_REWRITE_PARAMS)
+_answer_call = partial(_chat, model=MODEL, temperature=0.7, max_tokens=ANSWER_MAX_TOKENS, stream=True)
+
+
+async def classify_intent(prompt: str) -> Dict[str, str]:
+    """
+    Classifies the learning intent of a prompt and extracts the topic.
+    Uses the local embedding classifier when it is confident and only falls
+    back to an LLM call otherwise.
+    Returns: {"intent": "...", "topic": "..."}
+    """
+    logger.debug("classify_intent called with prompt length: %d", len(prompt))
+    if _EMBED_MODEL is not None:
+        # Embedding and parsing the prompt is CPU-bound, so it runs in a worker
+        # thread; the embedding is memoized, so the cache lookups below reuse it
+        local_result = await asyncio.to_thread(_classify_locally, prompt)
+        if local_result:
+            return local_result
+    cached = _intent_cache.get(prompt)
+    if cached is not None:
+        return cached
+
+    classification_prompt = "".join((_CLASSIFY_PROMPT_HEAD, prompt, _CLASSIFY_PROMPT_TAIL))
 
     try:
-        logger.debug("Getting OpenAI client for classification...")
-        client = get_client()
         logger.debug("Calling OpenAI API for classification...")
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=[
-                {"role": "system", "content": "You are a learning intent classifier. Always respond with valid JSON only."},
-                {"role": "user", "content": classification_prompt}
-            ],
-            temperature=0.3,
-            response_format={"type": "json_object"}
+        response = await _classify_call(
+            messages=[_CLASSIFY_SYSTEM_MSG, {"role": "user", "content": classification_prompt}]
         )
         
-        import json
         content = response.choices[0].message.content
         if not content:
             return {"intent": "other", "topic": "general"}
-        result = json.loads(content)
-        return {
+        try:
+            result = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # No JSON mode, or the reply was cut off at max_tokens
+            result = dict(_INTENT_FIELD_RE.findall(content))
+        intent_result = {
             "intent": result.get("intent", "other"),
             "topic": result.get("topic", "general")
         }
+        # Defaults filled in for a missing field are not worth remembering
+        if "intent" in result and "topic" in result:
+            _intent_cache.put(prompt, intent_result)
+        return intent_result
     except Exception as e:
         # Fallback if classification fails
         return {"intent": "other", "topic": "general"}
 
 
-def rewrite_prompt(original_prompt: str, intent: str, mode: str) -> Tuple[Optional[str], str, List[str]]:
+def _parse_rewrite(result: Dict[str, Any], original_prompt: str, rewrite_strategy: str) -> Tuple[str, str, List[str]]:
+    """Extracts (rewritten_prompt, rewrite_strategy, prompt_feedback) from a parsed rewrite response"""
+    prompt_feedback = result.get("promptFeedback", [])
+    # Ensure prompt_feedback is a list
+    if not isinstance(prompt_feedback, list):
+        prompt_feedback = []
+    return (
+        result.get("rewrittenPrompt", original_prompt),
+        result.get("rewriteStrategy", rewrite_strategy),
+        prompt_feedback,
+    )
+
+
+@lru_cache(maxsize=64)
+def _rewrite_template(mode: str, intent: str) -> str:
+    """Rewrite prompt for a (mode, intent) pair, from just after the user's prompt to the end"""
+    rewrite_instruction, rewrite_strategy = _MODE_REWRITES[mode]
+    return f"""\"
+- mode: {mode}
+- intent: {intent}
+{_INTENT_GUIDANCE.get(intent, "")}
+
+You MUST:
+1. Rewrite the prompt (if helpful for this mode and intent).
+{_REWRITE_REQUIREMENTS}
+
+Rewriting instruction:
+{rewrite_instruction}
+
+Respond in strict JSON: {{"rewrittenPrompt": "...", "rewriteStrategy": "{rewrite_strategy}", "promptFeedback": ["...", "..."]}}"""
+
+
+def _rewrite_messages(original_prompt: str, intent: str, mode: str) -> List[Dict[str, str]]:
+    """Builds the chat messages for rewriting a prompt in a known mode"""
+    rewrite_prompt_text = "".join((_REWRITE_PROMPT_HEAD, original_prompt, _rewrite_template(mode, intent)))
+    return [_REWRITE_SYSTEM_MSG, {"role": "user", "content": rewrite_prompt_text}]
+
+
+async def rewrite_prompt(original_prompt: str, intent: str, mode: str) -> Tuple[Optional[str], str, List[str]]:
     """
     Rewrites a prompt to be more learning-oriented based on mode and intent.
     
@@ -119,164 +682,35 @@ def rewrite_prompt(original_prompt: str, intent: str, mode: str) -> Tuple[Option
         - rewrite_strategy: "learning_explanation", "socratic_questioning", or "other"
         - prompt_feedback: List of 2-3 bullet points explaining what changed and why
     """
-    # Build rewrite instructions based on mode
-    if mode == "learning":
-        rewrite_instruction = """
-Rewrite this prompt so that it turns the original question into a **deep, structured learning task**, not just a more verbose version.
-
-The rewritten prompt should:
-- Keep the user’s original goal and topic.
-- Start with a request for a **high-level intuition first**, then a more formal explanation.
-- Ask for a **step-by-step walkthrough** (when relevant, e.g., algorithms / processes).
-- Ask for **2–3 concrete examples or scenarios** that make the idea feel real.
-- (If applicable) Ask for **a small numerical or code example** to ground the idea.
-- End with **1 short diagnostic question or mini-exercise** the user can use to test themselves.
-
-Constraints:
-- Keep the rewritten prompt to 1–3 sentences or bullet points (concise but structured).
-- Do NOT restate the original prompt text verbatim; transform it into clear instructions to the LLM.
-
-Example style:
-"Explain [concept] starting from an intuitive explanation, then give a step-by-step walkthrough and a small numerical example. After that, show 2–3 real-world applications, and finish with a short question I can answer to check my understanding."
-"""
-        rewrite_strategy = "learning_explanation"
-
-    elif mode == "socratic":
-        rewrite_instruction = """
-    Rewrite the user's prompt into a **strict meta-instruction** that tells the LLM how to behave as a Socratic tutor.
-
-    The rewritten prompt must enforce ALL of the following rules:
-
-    1. Start by asking the user **exactly 2 clarifying questions**, one after the other.
-    2. DO NOT provide ANY explanation, definitions, hints, or teaching until the user has answered **BOTH** questions.
-    3. After the user answers both questions, ask **1 additional probing question** based on their response.
-    4. ONLY AFTER the user answers that probing question may you begin explaining the concept.
-    5. When you explain, tailor it **specifically** to the user's expressed misunderstandings.
-    6. Continue tutoring by alternating between:
-    - asking a targeted question,
-    - waiting for the user's answer,
-    - giving a **small, incremental** explanation.
-    7. NEVER give a full explanation in one dump. Break explanations into small pieces.
-    8. NEVER skip ahead to teaching before the user has responded to your questions.
-    9. Maintain a tone that is curious, patient, and encouraging.
-
-    Important:
-    - The rewritten prompt should NOT contain the actual questions or explanations.
-    - It should be a **meta-instruction** describing HOW the LLM should conduct the interaction, not the content itself.
-
-    Example style:
-    "You are a Socratic tutor. Begin by asking me exactly two clarifying questions about my understanding of [topic]. Wait for my responses before explaining anything. After I answer both, ask one targeted follow-up question. Only then begin a step-by-step explanation tailored to my answers. Continue alternating between asking and explaining in small increments."
-
-    Return only the rewritten meta-prompt.
-    """
-        rewrite_strategy = "socratic_questioning"
-
-    else:
+    if mode not in _MODE_REWRITES:
         # Fallback: return original with "other" strategy
         logger.warning(f"Unknown mode '{mode}', returning original prompt")
         return (original_prompt, "other", [])
+    rewrite_strategy = _MODE_REWRITES[mode][1]
 
-    # Add intent-specific guidance
-    intent_guidance = ""
-    if intent == "debugging":
-        intent_guidance = """
-Because the intent is "debugging", make sure the rewritten prompt:
-- Asks the LLM to reason about likely root causes,
-- Requests an ordered checklist of things to try,
-- And ends by asking what extra context (error messages, code snippets) I should provide next time.
-"""
-    elif intent == "intuition":
-        intent_guidance = """
-Because the intent is "intuition", focus the rewritten prompt on:
-- metaphors, visualizations, and "why it works" reasoning,
-- comparisons to simpler ideas the user might already know,
-- and one or two probing questions that challenge common misconceptions.
-"""
-    elif intent == "example":
-        intent_guidance = """
-Because the intent is "example", make the rewritten prompt:
-- Ask explicitly for several diverse, concrete examples,
-- Include one example that is very close to a real-world scenario a student might see,
-- And ask for a brief explanation of why each example fits.
-"""
-    elif intent == "conceptual":
-        intent_guidance = """
-Because the intent is "conceptual", emphasize:
-- clear definitions,
-- connections between related concepts,
-- and a short summary that restates the idea in plain language.
-"""
-    # "direct_answer" and "other" just fall back to the general learning behaviour
-
-    # Build the rewrite prompt with both mode and intent context
-    rewrite_prompt_text = f"""You are a prompt rewriting assistant.
-
-Given:
-- the user's original prompt: "{original_prompt}"
-- the selected mode: {mode}
-- the detected intent: {intent}
-
-{intent_guidance}
-
-You MUST:
-1. Rewrite the prompt (if helpful for this mode and intent).
-2. Provide a short explanation (2-3 bullet points) for the user that:
-   - highlights the most important change you made (not every tiny tweak),
-   - ties that change directly to their original wording or goal,
-   - and gives ONE very concrete "next time you write a prompt, try X" tip.
-Avoid generic feedback like "this will enhance your learning" without specifics.
-
-Instruction for rewriting:
-{rewrite_instruction}
-
-Respond in strict JSON with:
-{{
-  "rewrittenPrompt": "...",
-  "rewriteStrategy": "{rewrite_strategy}",
-  "promptFeedback": [
-    "First bullet...",
-    "Second bullet...",
-    "Optional third bullet..."
-  ]
-}}"""
+    cache_key = f"{mode}:{intent}"
+    cached = _rewrite_cache.get(original_prompt, cache_key)
+    if cached is not None:
+        return tuple(cached)
 
     try:
-        logger.debug(f"Getting OpenAI client for prompt rewriting (mode={mode}, intent={intent})...")
-        client = get_client()
         logger.debug("Calling OpenAI API for prompt rewriting...")
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a prompt rewriting assistant that helps make prompts more learning-oriented. Always respond with valid JSON only."
-                },
-                {"role": "user", "content": rewrite_prompt_text},
-            ],
-            temperature=0.5,
-            response_format={"type": "json_object"},
-        )
+        response = await _rewrite_call(messages=_rewrite_messages(original_prompt, intent, mode))
 
         content = response.choices[0].message.content
         if not content:
             logger.warning("Empty response from rewrite API, returning original prompt")
             return (original_prompt, rewrite_strategy, [])
 
-        import json
         try:
-            result = json.loads(content)
-            rewritten_prompt = result.get("rewrittenPrompt", original_prompt)
-            rewrite_strategy = result.get("rewriteStrategy", rewrite_strategy)
-            prompt_feedback = result.get("promptFeedback", [])
-
-            # Ensure prompt_feedback is a list
-            if not isinstance(prompt_feedback, list):
-                prompt_feedback = []
-
+            rewritten_prompt, rewrite_strategy, prompt_feedback = _parse_rewrite(
+                orjson.loads(content), original_prompt, rewrite_strategy
+            )
             logger.info(f"✓ Prompt rewritten with strategy '{rewrite_strategy}' (length: {len(rewritten_prompt)})")
             logger.info(f"✓ Prompt feedback: {len(prompt_feedback)} bullets")
+            _rewrite_cache.put(original_prompt, [rewritten_prompt, rewrite_strategy, prompt_feedback], cache_key)
             return (rewritten_prompt, rewrite_strategy, prompt_feedback)
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.error(f"✗ Error parsing JSON response: {str(e)}", exc_info=True)
             logger.error(f"Response content: {content[:200]}...")
             # Fallback to original if JSON parsing fails
@@ -288,57 +722,223 @@ Respond in strict JSON with:
         return (original_prompt, rewrite_strategy, [])
 
 
+async def rewrite_prompt_multi(
+    original_prompt: str,
+    intent: str,
+    modes: List[str],
+) -> Dict[str, Tuple[Optional[str], str, List[str]]]:
+    """
+    Rewrites a prompt for several modes with a single LLM call. The combined
+    prompt lists each mode's rewrite instruction under its own heading and asks
+    for one JSON object keyed by mode, so the shared context and system message
+    are only sent once.
+
+    Returns a dict mapping each mode to the same tuple rewrite_prompt returns.
+    Cached modes are not requested again; with only one mode left this is a
+    plain rewrite_prompt call.
+    """
+    results: Dict[str, Tuple[Optional[str], str, List[str]]] = {}
+    pending = []
+    for mode in dict.fromkeys(modes):
+        if mode not in _MODE_REWRITES:
+            logger.warning(f"Unknown mode '{mode}', returning original prompt")
+            results[mode] = (original_prompt, "other", [])
+            continue
+        cached = _rewrite_cache.get(original_prompt, f"{mode}:{intent}")
+        if cached is not None:
+            results[mode] = tuple(cached)
+        else:
+            pending.append(mode)
+
+    if len(pending) == 1:
+        results[pending[0]] = await rewrite_prompt(original_prompt, intent, pending[0])
+    if len(pending) <= 1:
+        return results
+
+    rewrite_prompt_text = "".join((
+        _REWRITE_PROMPT_HEAD, original_prompt, '"\n- intent: ', intent, "\n",
+        _INTENT_GUIDANCE.get(intent, ""), _MULTI_REWRITE_INSTRUCTIONS,
+        "\n".join(_MODE_SECTIONS[mode] for mode in pending),
+        "\n\nRespond in strict JSON with one object per mode:\n{\n",
+        ",\n".join(_MODE_SCHEMAS[mode] for mode in pending),
+        "\n}",
+    ))
+
+    try:
+        logger.debug("Calling OpenAI API for combined prompt rewriting (modes=%s, intent=%s)...", pending, intent)
+        response = await _rewrite_call(
+            messages=[_REWRITE_SYSTEM_MSG, {"role": "user", "content": rewrite_prompt_text}],
+            max_tokens=REWRITE_MAX_TOKENS * len(pending),
+        )
+        content = response.choices[0].message.content
+        combined = orjson.loads(content) if content else {}
+    except Exception as e:
+        logger.error(f"✗ Error in rewrite_prompt_multi: {str(e)}", exc_info=True)
+        combined = {}
+
+    for mode in pending:
+        rewrite_strategy = _MODE_REWRITES[mode][1]
+        section = combined.get(mode) if isinstance(combined, dict) else None
+        if not isinstance(section, dict):
+            # Fallback to original for any mode the model left out
+            results[mode] = (original_prompt, rewrite_strategy, [])
+            continue
+        results[mode] = _parse_rewrite(section, original_prompt, rewrite_strategy)
+        _rewrite_cache.put(original_prompt, list(results[mode]), f"{mode}:{intent}")
+    logger.info(f"✓ Prompt rewritten for {len(pending)} modes in one call")
+    return results
+
+
+async def rewrite_prompt_batch(
+    prompts: List[Tuple[str, str, str]],
+    use_batch_api: bool = True,
+) -> List[Tuple[Optional[str], str, List[str]]]:
+    """
+    Rewrites many (original_prompt, intent, mode) triples for offline jobs such
+    as evals or warming the rewrite cache.
+
+    With use_batch_api the requests go through the OpenAI Batch API (half the
+    price, completes within 24h): the payloads are uploaded as one JSONL file,
+    the job is polled every BATCH_POLL_INTERVAL seconds and its output is mapped
+    back by custom_id. Otherwise every triple goes through rewrite_prompt live.
+    Never use the Batch API for interactive requests.
 
-def get_llm_response(
+    Returns the rewrite_prompt tuples in the same order as prompts; failed
+    requests fall back to the original prompt.
+    """
+    if not use_batch_api:
+        return list(await asyncio.gather(*(rewrite_prompt(*item) for item in prompts)))
+
+    results: List[Tuple[Optional[str], str, List[str]]] = []
+    lines = []
+    for i, (original_prompt, intent, mode) in enumerate(prompts):
+        if mode not in _MODE_REWRITES:
+            results.append((original_prompt, "other", []))
+            continue
+        results.append((original_prompt, _MODE_REWRITES[mode][1], []))
+        lines.append(orjson.dumps({
+            "custom_id": f"req_{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {**_REWRITE_PARAMS, "messages": _rewrite_messages(original_prompt, intent, mode)},
+        }))
+    if not lines:
+        return results
+
+    try:
+        client = get_client()
+        batch_file = await client.files.create(file=("rewrites.jsonl", b"\n".join(lines)), purpose="batch")
+        batch = await client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        logger.info(f"✓ Submitted rewrite batch {batch.id} ({len(lines)} requests)")
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+            batch = await client.batches.retrieve(batch.id)
+        if batch.status != "completed" or not batch.output_file_id:
+            logger.error(f"✗ Rewrite batch {batch.id} ended with status '{batch.status}'")
+            return results
+        output = await client.files.content(batch.output_file_id)
+    except Exception as e:
+        logger.error(f"✗ Error in rewrite_prompt_batch: {str(e)}", exc_info=True)
+        return results
+
+    for line in output.text.splitlines():
+        if not line:
+            continue
+        try:
+            item = orjson.loads(line)
+            i = int(item["custom_id"].removeprefix("req_"))
+            original_prompt, intent, mode = prompts[i]
+            content = item["response"]["body"]["choices"][0]["message"]["content"]
+            results[i] = _parse_rewrite(orjson.loads(content), original_prompt, results[i][1])
+            _rewrite_cache.put(original_prompt, list(results[i]), f"{mode}:{intent}")
+        except Exception as e:
+            logger.warning(f"Skipping unusable batch result: {str(e)}")
+    logger.info(f"✓ Rewrite batch {batch.id} complete")
+    return results
+
+
+async def get_llm_response(
     prompt: str,
     conversation_history: List[Dict[str, str]] = None,
     socratic_system_prompt: Optional[str] = None,
-) -> str:
+) -> AsyncIterator[str]:
     """
-    Gets the final answer from the LLM for the given prompt.
+    Streams the final answer from the LLM for the given prompt, yielding text
+    chunks as they arrive so callers can forward them before the answer is complete.
     Includes conversation history for context if provided.
     If socratic_system_prompt is provided, uses it as the system message instead of the default.
+    Raises if the call fails, possibly after some chunks were yielded.
     """
-    logger.debug(f"get_llm_response called with prompt length: {len(prompt)}")
-    if conversation_history:
-        logger.debug(f"Conversation history: {len(conversation_history)} messages")
-    if socratic_system_prompt:
-        logger.debug("Using Socratic system prompt")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("get_llm_response called with prompt length: %d", len(prompt))
+        if conversation_history:
+            logger.debug("Conversation history: %d messages", len(conversation_history))
+        if socratic_system_prompt:
+            logger.debug("Using Socratic system prompt")
+    
+    logger.debug("Calling OpenAI API for final response...")
+    
+    # Use the Socratic prompt as the system message if provided, otherwise the default
+    system_msg = (
+        {"role": "system", "content": socratic_system_prompt}
+        if socratic_system_prompt else _ANSWER_SYSTEM_MSG
+    )
+    messages = [system_msg, *(conversation_history or ()), {"role": "user", "content": prompt}]
+    
+    stream = await _answer_call(messages=messages)
     
+    length = 0
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            length += len(delta)
+            yield delta
+    logger.debug("✓ Got response (length: %d)", length)
+    if not length:
+        yield "No response generated."
+
+
+async def get_llm_response_full(
+    prompt: str,
+    conversation_history: List[Dict[str, str]] = None,
+    socratic_system_prompt: Optional[str] = None,
+) -> str:
+    """
+    Collects the streamed answer from get_llm_response into a single string.
+    If the call fails, returns the error message as the answer.
+    """
     try:
-        logger.debug("Getting OpenAI client for final response...")
-        client = get_client()
-        logger.debug("Calling OpenAI API for final response...")
-        
-        # Build system message - use Socratic prompt if provided, otherwise use default
-        if socratic_system_prompt:
-            system_content = socratic_system_prompt
-        else:
-            system_content = (
-                "You are a helpful AI assistant focused on teaching and learning. "
-                "Provide clear, educational responses. You can reference previous parts of the conversation when relevant."
-            )
-        
-        messages = [{"role": "system", "content": system_content}]
-        
-        # Add conversation history if provided
-        if conversation_history:
-            messages.extend(conversation_history)
-        
-        # Add current prompt
-        messages.append({"role": "user", "content": prompt})
-        
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=messages,
-            temperature=0.7
-        )
-        
-        content = response.choices[0].message.content
-        logger.debug(f"✓ Got response (length: {len(content) if content else 0})")
-        return content if content else "No response generated."
+        return "".join([
+            chunk async for chunk in get_llm_response(prompt, conversation_history, socratic_system_prompt)
+        ])
     except Exception as e:
         logger.error(f"✗ Error in get_llm_response: {str(e)}", exc_info=True)
         logger.error(f"Error type: {type(e).__name__}")
         return f"Error getting LLM response: {str(e)}"
 
+
+async def process_prompt(
+    prompt: str,
+    modes: List[str],
+) -> Tuple[Dict[str, str], Dict[str, Tuple[Optional[str], str, List[str]]]]:
+    """
+    Runs the full enhancer pipeline for a prompt: classifies it, then rewrites it
+    for every requested mode.
+
+    Rewriting depends on the intent, so classification is awaited first; the
+    per-mode rewrites are then combined into a single LLM call by
+    rewrite_prompt_multi, so several modes cost one round-trip.
+
+    Returns:
+        A tuple of (intent_result, rewrites) where rewrites maps each mode to the
+        (rewritten_prompt, rewrite_strategy, prompt_feedback) tuple from rewrite_prompt.
+    """
+    intent_result = await classify_intent(prompt)
+    intent = intent_result.get("intent", "other")
+    return intent_result, await rewrite_prompt_multi(prompt, intent, modes)
@@ -1,26 +1,28 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, Literal, List, Dict
+from typing import Optional, Literal, List, Dict, Tuple
 import os
+import asyncio
 import logging
-import uuid
-from datetime import datetime
-from dotenv import load_dotenv
-from sqlalchemy import desc
+import orjson
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 # Configure logging
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
-# Load environment variables from .env file
-load_dotenv()
-
-from models import Interaction, SessionLocal, init_db
-from llm_helpers import classify_intent, rewrite_prompt, get_llm_response
+from models import Interaction, SessionLocal, begin_write, engine, get_db, init_db, new_id, upsert
+from llm_helpers import process_prompt, get_llm_response, get_llm_response_full, save_caches, close_client
+from conversation import (
+    forget_socratic_turn, load_last_socratic_turn, log_turn, remember_socratic_turn,
+    remember_turn, resolve_socratic_context
+)
 
 app = FastAPI(title="Learning Intent Agent API")
 
@@ -33,10 +35,39 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize database on startup
+# Initialize database and start the interaction log writer on startup
 @app.on_event("startup")
 async def startup_event():
-    init_db()
+    global _log_queue, _log_writer
+    try:
+        await init_db()
+    except Exception:
+        # Startup is aborted; close the connections it opened so the process can exit
+        await engine.dispose()
+        raise
+    _log_queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+    _log_writer = asyncio.create_task(log_writer())
+
+
+# Write out queued interactions, persist the prompt caches so a restart starts
+# warm, and close pooled connections
+@app.on_event("shutdown")
+async def shutdown_event():
+    # The queue and writer are missing if startup failed before creating them
+    try:
+        if _log_queue is not None and _log_writer is not None:
+            try:
+                await asyncio.wait_for(_log_queue.join(), LOG_SHUTDOWN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.error(f"✗ Shutting down with {_log_queue.qsize()} interaction(s) still unlogged")
+        if _log_writer is not None:
+            _log_writer.cancel()
+    finally:
+        try:
+            save_caches()
+            await close_client()
+        finally:
+            await engine.dispose()
 
 
 # ========== Request/Response Models ==========
@@ -48,6 +79,9 @@ class InteractRequest(BaseModel):
     conversationId: Optional[str] = None
 
 
+# Endpoints build responses with model_construct: every field is filled from
+# values the server produced, and FastAPI still checks them against the
+# response_model once when serializing
 class InteractResponse(BaseModel):
     interaction_id: str
     conversationId: str
@@ -79,6 +113,26 @@ class AnswerResponse(BaseModel):
 
 # ========== Helper Functions ==========
 
+_RATIONALE_DISABLED = "The enhancer is disabled, so the agent kept your original wording and sent it directly to the model."
+_RATIONALE_NO_MODE = "The enhancer is enabled but no mode was specified."
+_RATIONALE_KEPT = "You're in {} mode, so the agent kept your original wording and sent it directly to the model."
+_RATIONALE_OTHER_MODE = "You're in {} mode, so the agent processed your prompt accordingly."
+_MODES = ("learning", "socratic")
+
+# Rationale for a rewrite by (mode, intent); (mode, None) covers any other intent
+_RATIONALES: Dict[Tuple[str, Optional[str]], str] = {
+    ("learning", "conceptual"): "Your question was classified as conceptual and you're in Learning mode, so the agent expanded your prompt to encourage a deeper explanation with examples and a small exercise.",
+    ("learning", "direct_answer"): "Your question was classified as requesting a direct answer, but you're in Learning mode, so the agent transformed it into a learning opportunity with structured explanations and examples.",
+    ("learning", "debugging"): "Your question was classified as debugging, and you're in Learning mode, so the agent rewrote your prompt to guide you toward understanding the root cause with examples.",
+    ("learning", "intuition"): "Your question was classified as seeking intuition, and you're in Learning mode, so the agent expanded your prompt to focus on building deep understanding of why things work.",
+    ("learning", "example"): "Your question was classified as requesting examples, and you're in Learning mode, so the agent structured your prompt to request examples with clear explanations.",
+    ("learning", None): "You're in Learning mode, so the agent expanded your prompt to encourage a deeper explanation with examples and a small exercise.",
+    ("socratic", None): "Because you selected Socratic mode, the agent rewrote your prompt to encourage the model to ask you clarifying questions before explaining.",
+}
+# Rationale when the prompt was kept as-is, by mode
+_KEPT_RATIONALES = {mode: _RATIONALE_KEPT.format(mode.capitalize()) for mode in _MODES}
+
+
 def generate_decision_rationale(
     enhancer_enabled: bool,
     mode: Optional[str],
@@ -97,41 +151,27 @@ def generate_decision_rationale(
       - Rewrite is applied based on mode and intent classification
     """
     if not enhancer_enabled:
-        return "The enhancer is disabled, so the agent kept your original wording and sent it directly to the model."
+        return _RATIONALE_DISABLED
     
     if not mode:
-        return "The enhancer is enabled but no mode was specified."
+        return _RATIONALE_NO_MODE
     
     # If no rewrite happened (should be rare, but handle it)
     if not rewritten_prompt or not rewrite_strategy:
-        return f"You're in {mode.capitalize()} mode, so the agent kept your original wording and sent it directly to the model."
-    
-    # Build rationale based on mode, intent, and rewrite strategy
-    if mode == "learning":
-        if intent == "conceptual":
-            return f"Your question was classified as conceptual and you're in Learning mode, so the agent expanded your prompt to encourage a deeper explanation with examples and a small exercise."
-        elif intent == "direct_answer":
-            return f"Your question was classified as requesting a direct answer, but you're in Learning mode, so the agent transformed it into a learning opportunity with structured explanations and examples."
-        elif intent == "debugging":
-            return f"Your question was classified as debugging, and you're in Learning mode, so the agent rewrote your prompt to guide you toward understanding the root cause with examples."
-        elif intent == "intuition":
-            return f"Your question was classified as seeking intuition, and you're in Learning mode, so the agent expanded your prompt to focus on building deep understanding of why things work."
-        elif intent == "example":
-            return f"Your question was classified as requesting examples, and you're in Learning mode, so the agent structured your prompt to request examples with clear explanations."
-        else:
-            return f"You're in Learning mode, so the agent expanded your prompt to encourage a deeper explanation with examples and a small exercise."
+        return _KEPT_RATIONALES.get(mode) or _RATIONALE_KEPT.format(mode.capitalize())
     
-    elif mode == "socratic":
-        return f"Because you selected Socratic mode, the agent rewrote your prompt to encourage the model to ask you clarifying questions before explaining."
-    
-    else:
-        return f"You're in {mode.capitalize()} mode, so the agent processed your prompt accordingly."
+    # Look up the rationale for the mode and intent, falling back to the mode's default
+    return (
+        _RATIONALES.get((mode, intent))
+        or _RATIONALES.get((mode, None))
+        or _RATIONALE_OTHER_MODE.format(mode.capitalize())
+    )
 
 
 # ========== Endpoints ==========
 
 @app.post("/interact", response_model=InteractResponse)
-async def interact(request: InteractRequest):
+async def interact(request: InteractRequest, db: AsyncSession = Depends(get_db)):
     """
     Process user prompt with optional enhancement.
     - If enhancerEnabled is false: Generate final answer directly from raw prompt
@@ -142,147 +182,49 @@ async def interact(request: InteractRequest):
     logger.info(f"Mode: {request.mode or 'N/A (enhancer disabled)'}")
     logger.info(f"ConversationId: {request.conversationId or 'NEW'}")
     logger.info(f"Prompt length: {len(request.prompt)}")
-    logger.debug(f"Prompt: {request.prompt[:100]}...")
+    logger.debug("Prompt: %.100s...", request.prompt)
     
     # Generate interaction_id for this interaction pair
-    interaction_id = str(uuid.uuid4())
+    interaction_id = new_id()
     logger.info(f"Generated interaction_id: {interaction_id}")
     
     # Determine or create conversation_id
     conversation_id = request.conversationId
     if not conversation_id:
-        conversation_id = str(uuid.uuid4())
+        conversation_id = new_id()
         logger.info(f"Created new conversation_id: {conversation_id}")
     else:
         logger.info(f"Using existing conversation_id: {conversation_id}")
     
+    # Classification and rewriting don't depend on the conversation history, so
+    # start them now and let them run while the history is fetched
+    enhance_task = None
+    if request.enhancerEnabled:
+        if not request.mode:
+            raise HTTPException(
+                status_code=400, 
+                detail="mode is required when enhancerEnabled is true"
+            )
+        enhance_task = asyncio.create_task(process_prompt(request.prompt, [request.mode]))
+    
     # Fetch conversation history for context (used in both paths)
     conversation_history = []
     active_socratic_prompt = None
-    db = SessionLocal()
     try:
-        # Get current turn_index for expiration check
-        current_turn_index = 0
-        if conversation_id:
-            last_turn = db.query(Interaction).filter(
-                Interaction.conversation_id == conversation_id
-            ).order_by(desc(Interaction.turn_index)).first()
-            current_turn_index = (last_turn.turn_index + 1) if last_turn else 0
-        
-        # Fetch conversation history (last 5 turns for context)
-        if conversation_id:
-            # Get the most recent Socratic prompt (query all turns, not just last 5)
-            socratic_turn = db.query(Interaction).filter(
-                Interaction.conversation_id == conversation_id,
-                Interaction.socratic_system_prompt.isnot(None)
-            ).order_by(desc(Interaction.turn_index)).first()
-            
-            socratic_prompt_turn_index = None
-            if socratic_turn:
-                active_socratic_prompt = socratic_turn.socratic_system_prompt
-                socratic_prompt_turn_index = socratic_turn.turn_index
-                logger.debug(f"Found Socratic prompt at turn_index {socratic_prompt_turn_index}")
-            
-            # Fetch last 5 turns for conversation history (ordered descending to get most recent)
-            history_turns = db.query(Interaction).filter(
-                Interaction.conversation_id == conversation_id
-            ).order_by(desc(Interaction.turn_index)).limit(5).all()
-            
-            # Reverse to get chronological order for conversation history
-            history_turns = list(reversed(history_turns))
-            
-            logger.info(f"Found {len(history_turns)} previous turns for context")
-            
-            # Build conversation history for LLM
-            for prev_turn in history_turns:
-                if prev_turn.final_answer:  # Only include completed turns
-                    conversation_history.append({
-                        "role": "user",
-                        "content": prev_turn.original_prompt
-                    })
-                    conversation_history.append({
-                        "role": "assistant",
-                        "content": prev_turn.final_answer
-                    })
-            
-            # Expire Socratic prompt if it's been more than 3 turns
-            if active_socratic_prompt and socratic_prompt_turn_index is not None:
-                turns_since_socratic = current_turn_index - socratic_prompt_turn_index
-                if turns_since_socratic >= 3:
-                    logger.info(f"Socratic prompt expired after {turns_since_socratic} turns")
-                    active_socratic_prompt = None
-                else:
-                    logger.debug(f"Socratic prompt active (turns since: {turns_since_socratic})")
-            
-            # Check for consecutive non-enhanced prompts after Socratic prompt
-            should_clear_socratic = False
-            if active_socratic_prompt and socratic_prompt_turn_index is not None and not request.enhancerEnabled:
-                # Count consecutive non-enhanced interactions since the Socratic prompt
-                # Get all COMPLETED interactions after the Socratic prompt (must have final_answer)
-                recent_turns = db.query(Interaction).filter(
-                    Interaction.conversation_id == conversation_id,
-                    Interaction.turn_index > socratic_prompt_turn_index,
-                    Interaction.final_answer.isnot(None)  # Only count completed turns
-                ).order_by(desc(Interaction.turn_index)).all()  # Order descending to count from most recent
-                
-                logger.debug(f"Found {len(recent_turns)} completed turns after Socratic prompt (turn {socratic_prompt_turn_index})")
-                
-                # Count consecutive non-enhanced prompts from most recent backwards
-                consecutive_non_enhanced = 0
-                for turn in recent_turns:
-                    logger.debug(f"  Turn {turn.turn_index}: mode={turn.mode}, has_final_answer={turn.final_answer is not None}")
-                    # Non-enhanced: mode is None or empty string (enhancer disabled)
-                    if turn.mode is None or turn.mode == "":
-                        consecutive_non_enhanced += 1
-                    else:  # Enhanced prompt - stop counting (we only care about consecutive from the end)
-                        logger.debug(f"  Found enhanced turn {turn.turn_index}, stopping count")
-                        break
-                
-                # If current request is also non-enhanced, add 1 to the count
-                if not request.enhancerEnabled:
-                    consecutive_non_enhanced += 1
-                    logger.debug(f"  Current request is non-enhanced, total count: {consecutive_non_enhanced}")
-                
-                logger.info(f"Consecutive non-enhanced prompts since Socratic (turn {socratic_prompt_turn_index}): {consecutive_non_enhanced}")
-                
-                # Clear if 2 or more consecutive non-enhanced prompts
-                if consecutive_non_enhanced >= 2:
-                    logger.info(f"✓ CLEARING Socratic prompt after {consecutive_non_enhanced} consecutive non-enhanced prompt(s)")
-                    should_clear_socratic = True
-                    active_socratic_prompt = None
-                else:
-                    logger.debug(f"Socratic prompt remains active ({consecutive_non_enhanced} consecutive non-enhanced, need 2+)")
-            
-            # Detect explicit requests to stop questioning (still works immediately)
-            if active_socratic_prompt:
-                prompt_lower = request.prompt.lower()
-                stop_phrases = [
-                    "stop asking", "no more questions", "stop questioning", 
-                    "please stop", "don't ask", "no questions", "stop the questions",
-                    "go with the", "just explain", "give me the", "skip the questions",
-                    "start explaining", "begin explaining", "explain", "start the explanation",
-                    "i'm good", "nah im good", "im good", "that's enough", "thats enough"
-                ]
-                if any(phrase in prompt_lower for phrase in stop_phrases):
-                    logger.info("User explicitly requested to stop Socratic questioning - clearing prompt")
-                    should_clear_socratic = True
-                    active_socratic_prompt = None
-            
-            # Clear Socratic prompt from database if needed (BEFORE closing the session)
-            if should_clear_socratic and socratic_turn:
-                try:
-                    # Object is already attached to session, just update and commit
-                    socratic_turn.socratic_system_prompt = None
-                    db.commit()
-                    logger.info(f"✓ Cleared Socratic prompt from database (turn {socratic_turn.turn_index})")
-                except Exception as e:
-                    logger.error(f"✗ Error clearing Socratic prompt from database: {str(e)}", exc_info=True)
-                    db.rollback()
+        await wait_for_logged(conversation_id)
+        conversation_history, active_socratic_prompt, _ = await resolve_socratic_context(
+            db,
+            conversation_id,
+            current_turn_index=None,
+            user_prompt=request.prompt,
+            enhancer_enabled=request.enhancerEnabled
+        )
     except Exception as e:
         logger.error(f"✗ Error fetching conversation history: {str(e)}", exc_info=True)
         # Don't fail the request if history fetch fails, just continue without history
     finally:
-        db.close()
+        # Return the connection to the pool while the LLM works; the session stays usable
+        await db.close()
     
     try:
         # Top-level toggle logic
@@ -296,49 +238,36 @@ async def interact(request: InteractRequest):
             
             # Generate final answer from raw prompt with conversation history
             logger.info("Generating final answer from raw prompt...")
-            logger.debug(f"Conversation history: {len(conversation_history)} messages")
-            logger.debug(f"Active Socratic prompt: {'present' if active_socratic_prompt else 'none'}")
+            logger.debug("Conversation history: %d messages", len(conversation_history))
+            logger.debug("Active Socratic prompt: %s", "present" if active_socratic_prompt else "none")
             try:
-                final_answer = get_llm_response(
+                final_answer = await get_llm_response_full(
                     prompt=request.prompt,
                     conversation_history=conversation_history,
                     socratic_system_prompt=active_socratic_prompt
                 )
                 logger.info(f"✓ Got LLM response (length: {len(final_answer)})")
             except Exception as e:
-                logger.error(f"✗ Error in get_llm_response: {str(e)}", exc_info=True)
+                logger.error(f"✗ Error in get_llm_response_full: {str(e)}", exc_info=True)
                 raise
             
             # Log interaction
-            db = SessionLocal()
             try:
-                last_turn = db.query(Interaction).filter(
-                    Interaction.conversation_id == conversation_id
-                ).order_by(desc(Interaction.turn_index)).first()
-                
-                turn_index = (last_turn.turn_index + 1) if last_turn else 0
-                
-                interaction = Interaction(
-                    timestamp=datetime.now(),
+                interaction = await log_turn(
+                    db,
                     interaction_id=interaction_id,
                     conversation_id=conversation_id,
-                    turn_index=turn_index,
                     original_prompt=request.prompt,
                     mode="",  # Empty string when enhancer is disabled (database may not allow NULL)
                     intent="",  # Empty string when enhancer is disabled (database may not allow NULL)
                     topic="",  # Empty string when enhancer is disabled (database may not allow NULL)
                     rewritten_prompt=None,
-                    final_answer=final_answer[:500]  # Store summary
+                    final_answer=final_answer
                 )
-                
-                db.add(interaction)
-                db.commit()
-                logger.info(f"✓ Interaction logged (interaction_id: {interaction_id}, turn: {turn_index})")
+                logger.info(f"✓ Interaction logged (interaction_id: {interaction_id}, turn: {interaction.turn_index})")
             except Exception as e:
                 logger.error(f"✗ Error logging interaction: {str(e)}", exc_info=True)
-                db.rollback()
-            finally:
-                db.close()
+                await db.rollback()
             
             # Generate decision rationale
             decision_rationale = generate_decision_rationale(
@@ -351,7 +280,7 @@ async def interact(request: InteractRequest):
             
             # Return response
             logger.info("=== /interact REQUEST COMPLETE ===")
-            return InteractResponse(
+            return InteractResponse.model_construct(
                 interaction_id=interaction_id,
                 conversationId=conversation_id,
                 intent=None,
@@ -366,43 +295,27 @@ async def interact(request: InteractRequest):
         
         else:
             # Enhancer enabled: run existing behavior
-            if not request.mode:
-                raise HTTPException(
-                    status_code=400, 
-                    detail="mode is required when enhancerEnabled is true"
-                )
-            
-            # Step 1: Classify intent and extract topic
-            logger.info("Step 1: Classifying intent...")
-            try:
-                intent_result = classify_intent(request.prompt)
-                intent = intent_result.get("intent", "other")
-                topic = intent_result.get("topic", "general")
-                logger.info(f"✓ Intent classified: {intent}, Topic: {topic}")
-            except Exception as e:
-                logger.error(f"✗ Error in classify_intent: {str(e)}", exc_info=True)
-                raise
-            
-            # Step 2: Rewrite prompt based on mode and intent
-            logger.info(f"Step 2: Processing mode '{request.mode}' with intent '{intent}'...")
+            # Steps 1 and 2: Classify intent and extract topic, then rewrite prompt
+            # based on mode and intent (started before the history fetch)
+            logger.info(f"Steps 1-2: Classifying intent and rewriting for mode '{request.mode}'...")
             rewritten_prompt = None
             rewrite_strategy = None
             prompt_feedback_bullets = []
             
             try:
-                rewritten_prompt, rewrite_strategy, prompt_feedback_bullets = rewrite_prompt(
-                    original_prompt=request.prompt,
-                    intent=intent,
-                    mode=request.mode
-                )
+                intent_result, rewrites = await enhance_task
+                intent = intent_result.get("intent", "other")
+                topic = intent_result.get("topic", "general")
+                logger.info(f"✓ Intent classified: {intent}, Topic: {topic}")
+                rewritten_prompt, rewrite_strategy, prompt_feedback_bullets = rewrites[request.mode]
                 logger.info(f"✓ Rewrite complete - strategy: '{rewrite_strategy}'")
                 if rewritten_prompt:
                     logger.info(f"✓ Rewritten prompt length: {len(rewritten_prompt)}")
-                    logger.debug(f"Rewritten prompt: {rewritten_prompt[:200]}...")
+                    logger.debug("Rewritten prompt: %.200s...", rewritten_prompt)
                 if prompt_feedback_bullets:
                     logger.info(f"✓ Prompt feedback: {len(prompt_feedback_bullets)} bullets")
             except Exception as e:
-                logger.error(f"✗ Error in rewrite_prompt: {str(e)}", exc_info=True)
+                logger.error(f"✗ Error in process_prompt: {str(e)}", exc_info=True)
                 raise
             
             # Format prompt feedback bullets
@@ -413,19 +326,11 @@ async def interact(request: InteractRequest):
             # which prompt version to use (original, rewritten, or edited).
             
             # Log stub interaction (without final_answer - will be filled in by /answer)
-            db = SessionLocal()
             try:
-                last_turn = db.query(Interaction).filter(
-                    Interaction.conversation_id == conversation_id
-                ).order_by(desc(Interaction.turn_index)).first()
-                
-                turn_index = (last_turn.turn_index + 1) if last_turn else 0
-                
-                interaction = Interaction(
-                    timestamp=datetime.now(),
+                interaction = await log_turn(
+                    db,
                     interaction_id=interaction_id,
                     conversation_id=conversation_id,
-                    turn_index=turn_index,
                     original_prompt=request.prompt,
                     mode=request.mode,
                     intent=intent,
@@ -433,15 +338,10 @@ async def interact(request: InteractRequest):
                     rewritten_prompt=rewritten_prompt,
                     final_answer=None  # Will be set by /answer endpoint
                 )
-                
-                db.add(interaction)
-                db.commit()
-                logger.info(f"✓ Stub interaction logged (interaction_id: {interaction_id}, turn: {turn_index})")
+                logger.info(f"✓ Stub interaction logged (interaction_id: {interaction_id}, turn: {interaction.turn_index})")
             except Exception as e:
                 logger.error(f"✗ Error logging interaction: {str(e)}", exc_info=True)
-                db.rollback()
-            finally:
-                db.close()
+                await db.rollback()
             
             # Generate decision rationale
             decision_rationale = generate_decision_rationale(
@@ -454,7 +354,7 @@ async def interact(request: InteractRequest):
             
             # Return response (without final_answer - will be generated by /answer)
             logger.info("=== /interact REQUEST COMPLETE ===")
-            return InteractResponse(
+            return InteractResponse.model_construct(
                 interaction_id=interaction_id,
                 conversationId=conversation_id,
                 intent=intent,
@@ -475,20 +375,17 @@ async def interact(request: InteractRequest):
         raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
 
 
-@app.post("/answer", response_model=AnswerResponse)
-async def answer(request: AnswerRequest):
+async def prepare_answer(request: AnswerRequest, db: AsyncSession):
     """
-    Step 2: Generate final answer based on user's chosen prompt.
-    - Accepts the chosen prompt (original, rewritten, or edited)
-    - Generates final answer with conversation context
-    - Logs the complete interaction with chosen_version
+    Resolves the conversation and turn an answer belongs to, plus the history and
+    Socratic prompt to generate it with.
+    Returns (conversation_id, turn_index, conversation_history, active_socratic_prompt).
     """
-    logger.info(f"=== NEW /answer REQUEST ===")
     logger.info(f"Interaction ID: {request.interaction_id or 'NONE'}")
     logger.info(f"ConversationId: {request.conversationId or 'NONE'}")
     logger.info(f"Chosen version: {request.chosen_version or 'NONE'}")
     logger.info(f"Prompt length: {len(request.prompt)}")
-    logger.debug(f"Prompt: {request.prompt[:200]}...")
+    logger.debug("Prompt: %.200s...", request.prompt)
     
     # Determine conversation_id and fetch history
     conversation_id = request.conversationId
@@ -496,13 +393,15 @@ async def answer(request: AnswerRequest):
     conversation_history = []
     active_socratic_prompt = None
     
-    db = SessionLocal()
     try:
         # If we have an interaction_id, try to find the stub interaction
+        # (only the two columns needed, not the whole row)
         if request.interaction_id:
-            stub_interaction = db.query(Interaction).filter(
-                Interaction.interaction_id == request.interaction_id
-            ).first()
+            stub_interaction = (await db.execute(
+                select(Interaction.conversation_id, Interaction.turn_index)
+                .where(Interaction.interaction_id == request.interaction_id)
+                .limit(1)
+            )).first()
             
             if stub_interaction:
                 conversation_id = stub_interaction.conversation_id
@@ -511,199 +410,217 @@ async def answer(request: AnswerRequest):
         
         # If no conversation_id yet, create one
         if not conversation_id:
-            conversation_id = str(uuid.uuid4())
+            conversation_id = new_id()
             logger.info(f"Created new conversation_id: {conversation_id}")
         
-        # Get turn_index if not found from stub
-        if turn_index == 0:
-            last_turn = db.query(Interaction).filter(
-                Interaction.conversation_id == conversation_id
-            ).order_by(desc(Interaction.turn_index)).first()
-            turn_index = (last_turn.turn_index + 1) if last_turn else 0
-        
-        # Get the most recent Socratic prompt (query all turns, not just last 5)
-        socratic_turn = db.query(Interaction).filter(
-            Interaction.conversation_id == conversation_id,
-            Interaction.socratic_system_prompt.isnot(None)
-        ).order_by(desc(Interaction.turn_index)).first()
-        
-        socratic_prompt_turn_index = None
-        if socratic_turn:
-            active_socratic_prompt = socratic_turn.socratic_system_prompt
-            socratic_prompt_turn_index = socratic_turn.turn_index
-            logger.debug(f"Found Socratic prompt at turn_index {socratic_prompt_turn_index}")
-        
-        # Fetch last 5 turns for conversation history (ordered descending to get most recent)
-        history_turns = db.query(Interaction).filter(
-            Interaction.conversation_id == conversation_id
-        ).order_by(desc(Interaction.turn_index)).limit(5).all()
-        
-        # Reverse to get chronological order for conversation history
-        history_turns = list(reversed(history_turns))
-        
-        logger.info(f"Found {len(history_turns)} previous turns for context")
-        
-        # Build conversation history for LLM
-        for prev_turn in history_turns:
-            if prev_turn.final_answer:  # Only include completed turns
-                conversation_history.append({
-                    "role": "user",
-                    "content": prev_turn.original_prompt
-                })
-                conversation_history.append({
-                    "role": "assistant",
-                    "content": prev_turn.final_answer
-                })
-        
-        # Expire Socratic prompt if it's been more than 3 turns
-        if active_socratic_prompt and socratic_prompt_turn_index is not None:
-            turns_since_socratic = turn_index - socratic_prompt_turn_index
-            if turns_since_socratic >= 3:
-                logger.info(f"Socratic prompt expired after {turns_since_socratic} turns")
-                active_socratic_prompt = None
-            else:
-                logger.debug(f"Socratic prompt active (turns since: {turns_since_socratic})")
-        
-        # Detect explicit requests to stop questioning
-        should_clear_socratic = False
-        if active_socratic_prompt:
-            prompt_lower = request.prompt.lower()
-            stop_phrases = [
-                "stop asking", "no more questions", "stop questioning", 
-                "please stop", "don't ask", "no questions", "stop the questions",
-                "go with the", "just explain", "give me the", "skip the questions",
-                "start explaining", "begin explaining", "explain", "start the explanation",
-                "i'm good", "nah im good", "im good", "that's enough", "thats enough"
-            ]
-            if any(phrase in prompt_lower for phrase in stop_phrases):
-                logger.info("User explicitly requested to stop Socratic questioning - clearing prompt")
-                should_clear_socratic = True
-                active_socratic_prompt = None
-        
-        # Clear Socratic prompt from database if user explicitly requested to stop
-        if should_clear_socratic and socratic_turn:
-            try:
-                socratic_turn.socratic_system_prompt = None
-                db.commit()
-                logger.info(f"✓ Cleared Socratic prompt from database (turn {socratic_turn.turn_index})")
-            except Exception as e:
-                logger.error(f"✗ Error clearing Socratic prompt from database: {str(e)}", exc_info=True)
-                db.rollback()
+        await wait_for_logged(conversation_id)
+        # A stub found at turn 0 falls back to the next free turn, as before
+        conversation_history, active_socratic_prompt, turn_index = await resolve_socratic_context(
+            db,
+            conversation_id,
+            current_turn_index=turn_index or None,
+            user_prompt=request.prompt,
+            enhancer_enabled=True
+        )
     except Exception as e:
         logger.error(f"✗ Error setting up conversation: {str(e)}", exc_info=True)
-        db.close()
         raise HTTPException(status_code=500, detail=f"Error setting up conversation: {str(e)}")
     finally:
-        db.close()
+        # Return the connection to the pool while the LLM works; the session stays usable
+        await db.close()
+    
+    return conversation_id, turn_index, conversation_history, active_socratic_prompt
+
+
+# /answer interactions are logged by a background writer rather than inside the
+# request: queued entries are written in batches of up to LOG_BATCH_SIZE, each
+# batch in one transaction with one commit. The writer waits up to
+# LOG_BATCH_WAIT seconds for an entry to gather more. Entries are held in memory
+# until written, so a crash loses the ones still queued.
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "50"))
+LOG_BATCH_WAIT = float(os.getenv("LOG_BATCH_WAIT", "0.02"))
+# Requests wait for room once this many entries are queued (e.g. while the database stalls)
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "1000"))
+# Seconds a request waits for a conversation's queued entries before reading its history anyway
+LOG_WAIT_TIMEOUT = 5.0
+# Seconds shutdown waits for queued entries to be written
+LOG_SHUTDOWN_TIMEOUT = 10.0
+_log_queue: Optional[asyncio.Queue] = None
+_log_writer: Optional[asyncio.Task] = None
+# Latest queued entry per conversation, set once it has been written
+_pending_logs: Dict[str, asyncio.Event] = {}
+
+
+async def log_answer(request: AnswerRequest, conversation_id: str, turn_index: int, final_answer: str):
+    """Queues the interaction for the background writer, waiting for room while the queue is full"""
+    written = asyncio.Event()
+    await _log_queue.put((request, conversation_id, turn_index, final_answer, written))
+    _pending_logs[conversation_id] = written
+
+
+def log_answer_nowait(request: AnswerRequest, conversation_id: str, turn_index: int, final_answer: str):
+    """log_answer for callers that can't wait (a stream being closed); drops the interaction if the queue is full"""
+    written = asyncio.Event()
+    try:
+        _log_queue.put_nowait((request, conversation_id, turn_index, final_answer, written))
+    except asyncio.QueueFull:
+        logger.error(f"✗ Log queue full, dropping interaction (conversation_id: {conversation_id}, turn: {turn_index})")
+        return
+    _pending_logs[conversation_id] = written
+
+
+async def wait_for_logged(conversation_id: str):
+    """Waits until queued interactions of the conversation are written, so its history is complete"""
+    written = _pending_logs.get(conversation_id)
+    if written is None:
+        return
+    try:
+        await asyncio.wait_for(written.wait(), LOG_WAIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"Interactions of conversation {conversation_id} still unlogged, reading its history anyway")
+
+
+async def log_writer():
+    """Drains the log queue until cancelled; an error only costs the batch it hit"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _log_queue.get()]
+        try:
+            deadline = loop.time() + LOG_BATCH_WAIT
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    if _log_queue.empty():
+                        batch.append(await asyncio.wait_for(_log_queue.get(), deadline - loop.time()))
+                    else:
+                        batch.append(_log_queue.get_nowait())
+                except asyncio.TimeoutError:
+                    break
+            await write_answer_logs(batch)
+        except Exception as e:
+            logger.error(f"✗ Error in interaction log writer: {str(e)}", exc_info=True)
+        finally:
+            for entry in batch:
+                conversation_id, written = entry[1], entry[4]
+                written.set()
+                if _pending_logs.get(conversation_id) is written:
+                    del _pending_logs[conversation_id]
+                _log_queue.task_done()
+
+
+async def write_answer_logs(batch):
+    """Writes a batch of queued interactions in one transaction; never raises"""
+    db = SessionLocal()
+    try:
+        # The Socratic checks (on a cache miss) and the writes below share one transaction
+        await begin_write(db)
+        interactions = [await upsert_answer(db, *entry[:4]) for entry in batch]
+        await db.commit()
+    except Exception as e:
+        logger.error(f"✗ Error logging {len(batch)} interaction(s) to database: {str(e)}", exc_info=True)
+        await db.rollback()
+        interactions = None
+        for entry in batch:
+            forget_socratic_turn(entry[1])
+    finally:
+        await db.close()
+    
+    if interactions is None:
+        # Retry one at a time so a single bad entry doesn't lose the whole batch
+        if len(batch) > 1:
+            for entry in batch:
+                await write_answer_logs([entry])
+        return
+    for interaction in interactions:
+        remember_turn(interaction)
+        logger.info(f"✓ Interaction logged (ID: {interaction.id}, conversation_id: {interaction.conversation_id}, turn: {interaction.turn_index})")
+
+
+async def upsert_answer(db, request: AnswerRequest, conversation_id: str, turn_index: int, final_answer: str) -> Interaction:
+    """Records the answer on the stub interaction, or logs a new one"""
+    # Store Socratic system prompt only if mode is socratic, rewritten prompt was used, AND no active
+    # Socratic prompt exists (to prevent resetting expiration); other answers skip the lookup
+    store_socratic = bool(
+        request.mode == "socratic" and request.chosen_version == "rewritten" and request.rewritten_prompt
+    )
+    if store_socratic:
+        last_socratic_turn = await load_last_socratic_turn(db, conversation_id)
+        # Another worker may have cleared the cached prompt since; confirm before
+        # dropping the new one
+        if last_socratic_turn is not None and (turn_index - last_socratic_turn) < 3:
+            last_socratic_turn = await load_last_socratic_turn(db, conversation_id, refresh=True)
+        # Active if it's within the last 3 turns (not expired)
+        if last_socratic_turn is not None and (turn_index - last_socratic_turn) < 3:
+            logger.debug("Active Socratic prompt found at turn %d, not storing new one", last_socratic_turn)
+            store_socratic = False
+    
+    values = {
+        "interaction_id": request.interaction_id,
+        "conversation_id": conversation_id,
+        "turn_index": turn_index,
+        "original_prompt": request.original_prompt or request.prompt,
+        "mode": request.mode,
+        "intent": request.intent,
+        "topic": request.topic,
+        "rewritten_prompt": request.rewritten_prompt,
+        "chosen_version": request.chosen_version,
+        "final_prompt": request.prompt,
+        "final_answer": final_answer,
+    }
+    # Columns /answer fills in on the stub interaction from /interact
+    update_columns = ["final_answer", "final_prompt", "chosen_version"]
+    if store_socratic:
+        values["socratic_system_prompt"] = request.rewritten_prompt
+        update_columns.append("socratic_system_prompt")
+    
+    # Complete the stub with the same interaction_id if there is one, otherwise insert
+    # a new row (a NULL interaction_id never conflicts)
+    stmt = upsert(Interaction).values(**values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Interaction.interaction_id],
+        set_={column: stmt.excluded[column] for column in update_columns}
+    )
+    interaction = (await db.scalars(stmt.returning(Interaction))).one()
+    if store_socratic:
+        # Recorded now so later entries of the same batch see it
+        remember_socratic_turn(conversation_id, interaction.turn_index)
+        logger.info(f"✓ Stored new Socratic prompt at turn {interaction.turn_index}")
+    return interaction
+
+
+@app.post("/answer", response_model=AnswerResponse)
+async def answer(request: AnswerRequest, db: AsyncSession = Depends(get_db)):
+    """
+    Step 2: Generate final answer based on user's chosen prompt.
+    - Accepts the chosen prompt (original, rewritten, or edited)
+    - Generates final answer with conversation context
+    - Logs the complete interaction with chosen_version
+    """
+    logger.info(f"=== NEW /answer REQUEST ===")
+    conversation_id, turn_index, conversation_history, active_socratic_prompt = await prepare_answer(request, db)
     
     try:
         # Generate final answer from chosen prompt
         logger.info("Generating final LLM response with context...")
-        logger.debug(f"Final prompt length: {len(request.prompt)}")
-        logger.debug(f"Conversation history: {len(conversation_history)} messages")
-        logger.debug(f"Active Socratic prompt: {'present' if active_socratic_prompt else 'none'}")
+        logger.debug("Final prompt length: %d", len(request.prompt))
+        logger.debug("Conversation history: %d messages", len(conversation_history))
+        logger.debug("Active Socratic prompt: %s", "present" if active_socratic_prompt else "none")
         try:
-            final_answer = get_llm_response(
+            final_answer = await get_llm_response_full(
                 prompt=request.prompt,
                 conversation_history=conversation_history,
                 socratic_system_prompt=active_socratic_prompt
             )
             logger.info(f"✓ Got LLM response (length: {len(final_answer)})")
-            logger.debug(f"Response preview: {final_answer[:200]}...")
+            logger.debug("Response preview: %.200s...", final_answer)
         except Exception as e:
-            logger.error(f"✗ Error in get_llm_response: {str(e)}", exc_info=True)
+            logger.error(f"✗ Error in get_llm_response_full: {str(e)}", exc_info=True)
             raise
         
-        # Log the complete interaction
-        logger.info("Logging complete interaction to database...")
-        db = SessionLocal()
-        try:
-            # Check if there's already an active Socratic prompt in recent turns
-            # Only store a new Socratic prompt if one doesn't already exist (to prevent resetting expiration)
-            has_active_socratic = False
-            if conversation_id:
-                recent_socratic = db.query(Interaction).filter(
-                    Interaction.conversation_id == conversation_id,
-                    Interaction.socratic_system_prompt.isnot(None)
-                ).order_by(desc(Interaction.turn_index)).first()
-                if recent_socratic:
-                    # Check if it's within the last 3 turns (not expired)
-                    turns_since = turn_index - recent_socratic.turn_index
-                    if turns_since < 3:
-                        has_active_socratic = True
-                        logger.debug(f"Active Socratic prompt found at turn {recent_socratic.turn_index}, not storing new one")
-            
-            # Try to update existing stub interaction if it exists
-            if request.interaction_id:
-                existing = db.query(Interaction).filter(
-                    Interaction.interaction_id == request.interaction_id
-                ).first()
-                
-                if existing:
-                    existing.final_answer = final_answer[:500]  # Store summary
-                    existing.final_prompt = request.prompt
-                    existing.chosen_version = request.chosen_version
-                    # Store Socratic system prompt only if mode is socratic, rewritten prompt was used, AND no active Socratic prompt exists
-                    if request.mode == "socratic" and request.chosen_version == "rewritten" and request.rewritten_prompt and not has_active_socratic:
-                        existing.socratic_system_prompt = request.rewritten_prompt
-                        logger.info(f"✓ Stored new Socratic prompt at turn {existing.turn_index}")
-                    db.commit()
-                    logger.info(f"✓ Updated existing interaction (ID: {existing.id})")
-                else:
-                    # Create new interaction record
-                    interaction = Interaction(
-                        timestamp=datetime.now(),
-                        interaction_id=request.interaction_id,
-                        conversation_id=conversation_id,
-                        turn_index=turn_index,
-                        original_prompt=request.original_prompt or request.prompt,
-                        mode=request.mode,
-                        intent=request.intent,
-                        topic=request.topic,
-                        rewritten_prompt=request.rewritten_prompt,
-                        chosen_version=request.chosen_version,
-                        final_prompt=request.prompt,
-                        final_answer=final_answer[:500]
-                    )
-                    # Store Socratic system prompt only if mode is socratic, rewritten prompt was used, AND no active Socratic prompt exists
-                    if request.mode == "socratic" and request.chosen_version == "rewritten" and request.rewritten_prompt and not has_active_socratic:
-                        interaction.socratic_system_prompt = request.rewritten_prompt
-                        logger.info(f"✓ Stored new Socratic prompt at turn {turn_index}")
-                    db.add(interaction)
-                    db.commit()
-                    logger.info(f"✓ New interaction logged (interaction_id: {request.interaction_id})")
-            else:
-                # No interaction_id, create new record
-                interaction = Interaction(
-                    timestamp=datetime.now(),
-                    conversation_id=conversation_id,
-                    turn_index=turn_index,
-                    original_prompt=request.original_prompt or request.prompt,
-                    mode=request.mode,
-                    intent=request.intent,
-                    topic=request.topic,
-                    rewritten_prompt=request.rewritten_prompt,
-                    chosen_version=request.chosen_version,
-                    final_prompt=request.prompt,
-                    final_answer=final_answer[:500]
-                )
-                # Store Socratic system prompt only if mode is socratic, rewritten prompt was used, AND no active Socratic prompt exists
-                if request.mode == "socratic" and request.chosen_version == "rewritten" and request.rewritten_prompt and not has_active_socratic:
-                    interaction.socratic_system_prompt = request.rewritten_prompt
-                    logger.info(f"✓ Stored new Socratic prompt at turn {turn_index}")
-                db.add(interaction)
-                db.commit()
-                logger.info(f"✓ Interaction logged (conversation_id: {conversation_id}, turn: {turn_index})")
-        except Exception as e:
-            logger.error(f"✗ Error logging to database: {str(e)}", exc_info=True)
-            db.rollback()
-            # Don't fail the request if logging fails
-        finally:
-            db.close()
+        await log_answer(request, conversation_id, turn_index, final_answer)
         
         # Return response
         logger.info("=== /answer REQUEST COMPLETE ===")
-        return AnswerResponse(final_answer=final_answer)
+        return AnswerResponse.model_construct(final_answer=final_answer)
         
     except Exception as e:
         logger.error(f"✗✗✗ FATAL ERROR: {str(e)}", exc_info=True)
@@ -711,6 +628,63 @@ async def answer(request: AnswerRequest):
         raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
 
 
+def sse_event(payload: dict) -> bytes:
+    """Encodes one Server-Sent Events message"""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+@app.post("/answer/stream")
+async def answer_stream(request: AnswerRequest, db: AsyncSession = Depends(get_db)):
+    """
+    Same as /answer, but streams the answer as Server-Sent Events while it is
+    generated: {"delta": ...} messages, then {"done": true} once complete, or
+    {"error": ...} if generation fails. The interaction is logged before the
+    last message (an answer cut short by a disconnect is logged as far as it
+    got; a failed one is not logged).
+    """
+    logger.info(f"=== NEW /answer/stream REQUEST ===")
+    conversation_id, turn_index, conversation_history, active_socratic_prompt = await prepare_answer(request, db)
+    
+    async def events():
+        chunks = []
+        # Set once the turn is logged, or deliberately left unlogged after an error
+        settled = False
+        try:
+            try:
+                async for delta in get_llm_response(
+                    prompt=request.prompt,
+                    conversation_history=conversation_history,
+                    socratic_system_prompt=active_socratic_prompt
+                ):
+                    chunks.append(delta)
+                    yield sse_event({"delta": delta})
+            except Exception as e:
+                # A failed answer is not logged, so it never becomes conversation history
+                logger.error(f"✗ Error streaming LLM response: {str(e)}", exc_info=True)
+                settled = True
+                yield sse_event({"error": str(e)})
+                return
+            
+            final_answer = "".join(chunks)
+            logger.info(f"✓ Streamed LLM response (length: {len(final_answer)})")
+            await log_answer(request, conversation_id, turn_index, final_answer)
+            settled = True
+            yield sse_event({"done": True})
+            logger.info("=== /answer/stream REQUEST COMPLETE ===")
+        finally:
+            # The stream was closed early (client disconnected): log the part of
+            # the answer that was sent
+            if not settled and chunks:
+                logger.info("Stream closed early, logging the partial answer")
+                log_answer_nowait(request, conversation_id, turn_index, "".join(chunks))
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @app.get("/health")
 async def health():
     """Health check endpoint"""
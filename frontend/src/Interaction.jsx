@@ -476,7 +476,7 @@ function Interaction() {
 
     // Now call /answer endpoint to generate the answer for the chosen prompt
     try {
-      const answerResponse = await fetch(`${API_URL}/answer`, {
+      const answerResponse = await fetch(`${API_URL}/answer/stream`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -498,14 +498,39 @@ function Interaction() {
         throw new Error(`HTTP error! status: ${answerResponse.status}`);
       }
 
-      const answerData = await answerResponse.json();
+      // Read the Server-Sent Events stream, showing the answer as it is generated
+      const reader = answerResponse.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let answerText = '';
+      let done = false;
+      while (!done) {
+        const { value, done: streamDone } = await reader.read();
+        if (streamDone) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const event of events) {
+          if (!event.startsWith('data: ')) continue;
+          const data = JSON.parse(event.slice(6));
+          if (data.error) throw new Error(data.error);
+          if (data.done) {
+            done = true;
+            break;
+          }
+          answerText += data.delta;
+          setTurns(prev => prev.map(t => 
+            t.id === turnId ? { ...t, final_answer: answerText } : t
+          ));
+        }
+      }
 
       // Update the turn with the final answer
       setTurns(prev => prev.map(t => 
         t.id === turnId 
           ? {
               ...t,
-              final_answer: answerData.final_answer,
+              final_answer: answerText,
               reasoningStage: 'done',
             }
           : t
@@ -817,12 +842,20 @@ function Interaction() {
                   {/* Assistant answer - with inline reasoning strip if available */}
                   {turn.reasoningStage === 'answering' && (
                     <div className="assistant-bubble">
-                      <div className="bubble-content">
-                        <div className="answer-loading-indicator">
-                          <div className="spinner"></div>
-                          <span>Generating answer...</span>
+                      {turn.final_answer ? (
+                        <div className="answer-message-wrapper answer-message-wrapper-tier1">
+                          <div className="answer-body-text">
+                            <MarkdownMessage text={turn.final_answer} />
+                          </div>
                         </div>
-                      </div>
+                      ) : (
+                        <div className="bubble-content">
+                          <div className="answer-loading-indicator">
+                            <div className="spinner"></div>
+                            <span>Generating answer...</span>
+                          </div>
+                        </div>
+                      )}
                     </div>
                   )}
 